@@ -0,0 +1,207 @@
+"""AI自我对局竞技场
+
+不依赖Socket.IO，在多个工作进程中批量进行AI之间的对局，每个参赛AI使用自己的参数（AIConfig
+及搜索预算），统计胜率及其置信区间、Elo和每步平均CPU耗时，用于挑选单位CPU时间内最强的配置。
+
+参赛配置写在JSON文件里：
+    {
+        "event_weights": {"extra_trigger": 0.5},
+        "ais": {
+            "baseline": {},
+            "explore-2": {"exploration": 2.0},
+            "cheap": {"iterations": 20, "epsilon": 0.05}
+        }
+    }
+"ais"中每项可以设置AIConfig的字段以及iterations、think_ms、rollout_batch、table_size、pool_nodes，
+"value_store"为价值库文件的路径（只读取，不写入）；
+"event_weights"（可选）是所有对局实际使用的事件权重，AI自己的"event_weights"只影响它搜索时的假设。
+--learn把所有对局记入指定的价值库（由主进程写入），可以先用自我对局积累经验，再用"value_store"比较。
+
+用法:
+    python arena.py configs.json --games 2000 --workers 8 --output arena.json
+    python arena.py configs.json --games 5000 --learn values.tvs
+"""
+import argparse
+import itertools
+import json
+import math
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import fields
+
+from server import AIConfig, EventWeights, GameAI, GameState, ValueStore
+
+# GameAI构造参数中属于搜索预算的部分，其余键都交给AIConfig
+SEARCH_KEYS = ("iterations", "think_ms", "rollout_batch", "table_size", "pool_nodes", "value_store")
+
+def build_ai(name, spec):
+    """由配置项创建GameAI；未知的键直接报错，避免拼写错误悄悄用了默认值"""
+    spec = dict(spec)
+    search = {key: spec.pop(key) for key in SEARCH_KEYS if key in spec}
+    search.setdefault("iterations", 50)
+    if search.get("value_store") is not None:
+        search["value_store"] = ValueStore(search["value_store"])
+    if "event_weights" in spec and spec["event_weights"] is not None:
+        spec["event_weights"] = EventWeights(**spec["event_weights"])
+    known = {f.name for f in fields(AIConfig)}
+    unknown = set(spec) - known
+    if unknown:
+        raise ValueError(f"未知的配置项: {', '.join(sorted(unknown))}")
+    return GameAI(name, config=AIConfig(**spec), **search)
+
+def play_game(job):
+    """进行一局对局，返回各座位的配置名、得分和CPU耗时，以及对局记录（"log"）"""
+    seats, specs, grid_size, event_weights, seed = job
+    random.seed(seed)
+    names = [f"P{i + 1}" for i in range(len(seats))]
+    ais = {name: build_ai(name, specs[seat]) for name, seat in zip(names, seats)}
+    state = GameState(grid_size, names, event_weights=EventWeights(**event_weights) if event_weights else None)
+    state.check_and_trigger_events()
+    cpu = {name: 0.0 for name in names}
+    moves = {name: 0 for name in names}
+    while not state.is_game_over():
+        name = names[state.turn % len(names)]
+        # 单线程对局中进程CPU时间就是这一步的计算量，不受其他进程抢占影响
+        started = time.process_time()
+        move = ais[name].get_action(state)
+        cpu[name] += time.process_time() - started
+        moves[name] += 1
+        if not state.apply_move(name, move):
+            # 与run_ai_turns相同：无法执行的行动改为收集木材
+            state.apply_move(name, ("collect_wood", None))
+    return {
+        "seats": list(seats),
+        "scores": [state.calculate_score(name) for name in names],
+        "cpu_s": [cpu[name] for name in names],
+        "moves": [moves[name] for name in names],
+        "log": bytes(state.log),
+    }
+
+def schedule(names, players, games, seed):
+    """循环赛：依次取每组配置组合，并轮换座位顺序抵消先手优势"""
+    matchups = list(itertools.combinations(names, players))
+    if not matchups:
+        raise ValueError(f"至少需要{players}个参赛配置")
+    for g in range(games):
+        seats = matchups[g % len(matchups)]
+        shift = (g // len(matchups)) % players
+        yield seats[shift:] + seats[:shift], seed + g
+
+def wilson_interval(wins, games, z=1.96):
+    """胜率的Wilson置信区间（默认95%），平局按半场胜计入wins"""
+    if games == 0:
+        return 0.0, 0.0
+    p = wins / games
+    denominator = 1 + z * z / games
+    centre = (p + z * z / (2 * games)) / denominator
+    spread = z * math.sqrt(p * (1 - p) / games + z * z / (4 * games * games)) / denominator
+    return max(0.0, centre - spread), min(1.0, centre + spread)
+
+def fit_elo(names, pairs, iterations=500):
+    """由两两比较结果拟合Bradley-Terry模型（MM迭代），换算为平均值为0的Elo
+
+    pairs为 {(a, b): (a的得分, 对局数)}，平局记0.5。每对配置先加一场虚拟平局，
+    全胜或全负的配置也能得到有限的Elo。
+    """
+    score = {name: 0.0 for name in names}
+    count: dict = {}
+    for (a, b), (a_score, n) in pairs.items():
+        score[a] += a_score + 0.5
+        score[b] += n - a_score + 0.5
+        count[(a, b)] = count.get((a, b), 0) + n + 1
+    strength = {name: 1.0 for name in names}
+    for _ in range(iterations):
+        updated = {}
+        for name in names:
+            denominator = sum(n / (strength[a] + strength[b]) for (a, b), n in count.items() if name in (a, b))
+            updated[name] = score[name] / denominator if denominator else strength[name]
+        mean_log = sum(math.log(v) for v in updated.values()) / len(updated)
+        strength = {name: v / math.exp(mean_log) for name, v in updated.items()}
+    return {name: 400 * math.log10(v) for name, v in strength.items()}
+
+def summarize(names, results):
+    """汇总各配置的胜场、胜率区间、Elo和每步CPU耗时"""
+    summary = {name: {"games": 0, "wins": 0.0, "cpu_s": 0.0, "moves": 0} for name in names}
+    pairs: dict = {}
+    for result in results:
+        seats, scores = result["seats"], result["scores"]
+        best = max(scores)
+        winners = [seat for seat, score in zip(seats, scores) if score == best]
+        for seat, cpu, moves in zip(seats, result["cpu_s"], result["moves"]):
+            entry = summary[seat]
+            entry["games"] += 1
+            entry["cpu_s"] += cpu
+            entry["moves"] += moves
+            if seat in winners:
+                entry["wins"] += 1 / len(winners)
+        # 多人对局拆成座位两两之间的比较
+        for i, j in itertools.combinations(range(len(seats)), 2):
+            a, b = sorted((seats[i], seats[j]))
+            a_score, b_score = (scores[i], scores[j]) if a == seats[i] else (scores[j], scores[i])
+            won, n = pairs.get((a, b), (0.0, 0))
+            pairs[(a, b)] = (won + (1.0 if a_score > b_score else 0.5 if a_score == b_score else 0.0), n + 1)
+    elo = fit_elo(names, pairs)
+    for name, entry in summary.items():
+        low, high = wilson_interval(entry["wins"], entry["games"])
+        entry["win_rate"] = entry["wins"] / entry["games"] if entry["games"] else 0.0
+        entry["win_rate_ci95"] = [low, high]
+        entry["elo"] = elo[name]
+        entry["ms_per_move"] = entry["cpu_s"] * 1000 / entry["moves"] if entry["moves"] else 0.0
+    # 帕累托前沿：没有其他配置同时更强且更省时
+    for name, entry in summary.items():
+        entry["pareto"] = not any(other["elo"] > entry["elo"] and other["ms_per_move"] <= entry["ms_per_move"]
+                                  for other_name, other in summary.items() if other_name != name)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="AI自我对局竞技场")
+    parser.add_argument("configs", help="参赛配置的JSON文件")
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--players", type=int, default=2, help="每局的AI数")
+    parser.add_argument("--grid-size", type=int, default=9)
+    parser.add_argument("--workers", type=int, default=None, help="工作进程数，默认为CPU核数")
+    parser.add_argument("--seed", type=int, default=12345)
+    parser.add_argument("--output", help="把汇总和逐局结果写入JSON文件")
+    parser.add_argument("--learn", help="把所有对局记入该价值库文件")
+    args = parser.parse_args()
+
+    with open(args.configs, encoding="utf-8") as f:
+        spec = json.load(f)
+    ais = spec["ais"]
+    event_weights = spec.get("event_weights")
+    names = list(ais)
+    for name in names:
+        build_ai(name, ais[name])  # 开始前检查配置
+
+    jobs = [(seats, ais, args.grid_size, event_weights, seed)
+            for seats, seed in schedule(names, args.players, args.games, args.seed)]
+    store = ValueStore(args.learn) if args.learn else None
+    results = []
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for i, result in enumerate(pool.map(play_game, jobs, chunksize=4), 1):
+            log = result.pop("log")
+            if store is not None:
+                store.learn(log)
+            results.append(result)
+            if i % 50 == 0 or i == len(jobs):
+                print(f"{i}/{len(jobs)} 局, {time.perf_counter() - started:.0f}s", file=sys.stderr)
+
+    summary = summarize(names, results)
+    print(f"{'配置':<16}{'局数':>6}{'胜率':>8}{'95%区间':>16}{'Elo':>8}{'ms/步':>9}")
+    for name in sorted(names, key=lambda n: -summary[n]["elo"]):
+        entry = summary[name]
+        low, high = entry["win_rate_ci95"]
+        print(f"{name:<16}{entry['games']:>6}{entry['win_rate']:>8.3f}{f'[{low:.3f}, {high:.3f}]':>16}"
+              f"{entry['elo']:>8.0f}{entry['ms_per_move']:>9.2f}{'  *' if entry['pareto'] else ''}")
+    print("* 帕累托前沿：没有其他配置同时更强且更省时")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "configs": spec, "summary": summary, "games": results},
+                      f, indent=2, ensure_ascii=False)
+
+if __name__ == '__main__':
+    main()
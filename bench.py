@@ -0,0 +1,233 @@
+"""引擎性能基准测试
+
+不依赖Socket.IO，用固定随机种子生成局面，测量GameState和MCTS热点路径的耗时，
+结果写成JSON，便于在部署前比较两次运行、发现性能回退。默认设置（3种棋盘 x 3种玩家数）约1-2分钟完成，
+每种规格的决策耗时受--decision-time限制，搜索变慢时也不会拖长太多。
+
+用法:
+    python bench.py --output bench.json
+    python bench.py --quick --output new.json --compare quick.json
+比较时两次运行的迭代次数等设置必须相同，--quick的结果只能与--quick的结果比较。
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+
+from server import AIConfig, GameState, GameAI, MCTSNode, batched_rollout, evaluate, np, replay
+
+PLAYER_NAMES = ["player", "AI1", "AI2", "AI3"]
+
+# 比较时各指标的方向：True表示越大越好
+HIGHER_IS_BETTER = {"ops_per_s": True, "p50_ms": False, "p90_ms": False, "p99_ms": False}
+
+def make_position(grid_size, n_players, seed, rounds=3):
+    """用固定种子生成开局事件并随机走rounds个大回合后的局面"""
+    random.seed(seed)
+    state = GameState(grid_size, PLAYER_NAMES[:n_players])
+    state.check_and_trigger_events()
+    for _ in range(rounds * n_players):
+        player = state.players[state.turn % n_players]
+        if not state.apply_move(player, random.choice(state.available_moves(player))):
+            state.apply_move(player, ("collect_wood", None))
+    return state
+
+def measure(fn, min_time, min_runs=3):
+    """重复调用fn至少min_time秒且至少min_runs次，返回单次耗时统计"""
+    runs = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while runs < min_runs or elapsed < min_time:
+        fn()
+        runs += 1
+        elapsed = time.perf_counter() - start
+    return {"runs": runs, "per_op_us": elapsed / runs * 1e6, "ops_per_s": runs / elapsed}
+
+def percentiles(samples_ms):
+    ordered = sorted(samples_ms)
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {"runs": len(ordered), "mean_ms": statistics.fmean(ordered),
+            "p50_ms": pick(0.5), "p90_ms": pick(0.9), "p99_ms": pick(0.99)}
+
+def bench_case(grid_size, n_players, seed, args):
+    state = make_position(grid_size, n_players, seed)
+    player = state.players[state.turn % n_players]
+    result = {"grid_size": grid_size, "players": n_players}
+
+    result["copy"] = measure(state.copy, args.min_time)
+    result["available_moves"] = measure(lambda: state.available_moves(player), args.min_time)
+    result["calculate_score"] = measure(lambda: state.calculate_score(player), args.min_time)
+    result["is_game_over"] = measure(state.is_game_over, args.min_time)
+    # 由对局记录重建局面（开局事件 + rounds个大回合）
+    log = bytes(state.log)
+    result["replay"] = measure(lambda: replay(log), args.min_time)
+
+    # apply_move在预先准备好的副本上执行，副本的第一次写入（写时复制）计入耗时
+    moves = state.available_moves(player)
+    random.seed(seed)
+    batch = [(state.copy(), random.choice(moves)) for _ in range(2000)]
+    start = time.perf_counter()
+    for copy, move in batch:
+        copy.apply_move(player, move)
+    elapsed = time.perf_counter() - start
+    result["apply_move"] = {"runs": len(batch), "per_op_us": elapsed / len(batch) * 1e6,
+                            "ops_per_s": len(batch) / elapsed}
+
+    random.seed(seed)
+    node = MCTSNode(state, player)
+    result["simulate"] = measure(node.simulate, args.min_time)
+    result["evaluate"] = measure(lambda: evaluate(state), args.min_time)
+    random.seed(seed)
+    shallow = MCTSNode(state, player, config=AIConfig(rollout_depth=args.rollout_depth))
+    result["simulate_depth_limited"] = measure(shallow.simulate, args.min_time)
+    result["simulate_depth_limited"]["rollout_depth"] = args.rollout_depth
+    if np is not None:
+        random.seed(seed)
+        rollouts = measure(lambda: batched_rollout(state, args.batch), args.min_time)
+        rollouts["playouts_per_s"] = rollouts["ops_per_s"] * args.batch
+        result["batched_rollout"] = rollouts
+
+    # 每次决策用新的AI（不复用搜索树），局面也各不相同；总耗时超过decision_time后只做满MIN_DECISIONS次
+    latencies = []
+    budget_end = time.perf_counter() + args.decision_time
+    for i in range(args.decisions):
+        if i >= MIN_DECISIONS and time.perf_counter() > budget_end:
+            break
+        position = make_position(grid_size, n_players, seed + i + 1)
+        ai = GameAI(position.players[position.turn % n_players], iterations=args.iterations)
+        random.seed(seed + i)
+        start = time.perf_counter()
+        ai.get_action(position)
+        latencies.append((time.perf_counter() - start) * 1000)
+    result["get_action"] = percentiles(latencies)
+    result["get_action"]["iterations"] = args.iterations
+    return result
+
+# 每种规格get_action至少决策的次数，不受decision_time限制
+MIN_DECISIONS = 3
+
+def smoke_checks():
+    """基准之前的冒烟检查：不容易在微基准中暴露的搜索路径必须能完整跑通，失败时直接抛出异常"""
+    # 根并行：局面要能发送到工作进程
+    state = make_position(9, 3, 1)
+    ai = GameAI(state.players[state.turn % 3], iterations=20, workers=2)
+    ai.get_action(state)
+    assert ai.last_stats.iterations == 40, "根并行没有合并两个进程的搜索"
+    # NodePool自我对局：有NumPy时边数组带有视图，移除无法执行的行动不能改变数组长度
+    for seed in range(3):
+        random.seed(seed)
+        state = GameState(9, PLAYER_NAMES[:2])
+        state.check_and_trigger_events()
+        ais = {name: GameAI(name, iterations=30, pool_nodes=2000) for name in state.players}
+        while not state.is_game_over():
+            player = state.players[state.turn % 2]
+            if not state.apply_move(player, ais[player].get_action(state)):
+                state.apply_move(player, ("collect_wood", None))
+
+# 影响测量结果的设置，不同时两次结果不可比较
+COMPARED_SETTINGS = ("iterations", "decisions", "batch", "rollout_depth")
+
+def mismatched_settings(current, baseline):
+    """返回两次运行中取值不同的设置"""
+    return [key for key in COMPARED_SETTINGS if current["meta"].get(key) != baseline["meta"].get(key)]
+
+def compare(current, baseline, tolerance):
+    """返回比baseline慢超过tolerance比例的指标"""
+    regressions = []
+    old_cases = {(c["grid_size"], c["players"]): c for c in baseline["results"]}
+    for case in current["results"]:
+        old = old_cases.get((case["grid_size"], case["players"]))
+        if old is None:
+            continue
+        for name, metrics in case.items():
+            if not isinstance(metrics, dict) or name not in old:
+                continue
+            for metric, higher_better in HIGHER_IS_BETTER.items():
+                if metric not in metrics or metric not in old[name]:
+                    continue
+                new_value, old_value = metrics[metric], old[name][metric]
+                if higher_better:
+                    worse = new_value < old_value * (1 - tolerance)
+                else:
+                    worse = new_value > old_value * (1 + tolerance)
+                if worse:
+                    regressions.append({"grid_size": case["grid_size"], "players": case["players"],
+                                        "benchmark": name, "metric": metric,
+                                        "baseline": old_value, "current": new_value})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="GameState / MCTS 性能基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[9, 19, 50])
+    parser.add_argument("--players", type=int, nargs="+", default=[2, 3, 4])
+    parser.add_argument("--seed", type=int, default=12345)
+    parser.add_argument("--min-time", type=float, default=0.5, help="每项微基准的最短测量时间（秒）")
+    parser.add_argument("--iterations", type=int, default=50, help="get_action每次决策的迭代次数")
+    parser.add_argument("--decisions", type=int, default=20, help="get_action的决策次数上限")
+    parser.add_argument("--decision-time", type=float, default=10.0,
+                        help="每种规格get_action决策的总时间上限（秒），超过后不再开始新的决策")
+    parser.add_argument("--batch", type=int, default=32, help="批量模拟的局数")
+    parser.add_argument("--rollout-depth", type=int, default=8, help="限深模拟的步数")
+    parser.add_argument("--quick", action="store_true", help="缩短测量时间、减少迭代次数并跳过50x50，用于快速检查")
+    parser.add_argument("--smoke", action="store_true", help="只运行冒烟检查")
+    parser.add_argument("--output", default="bench.json")
+    parser.add_argument("--compare", help="与之前的结果文件比较")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="判定回退的相对幅度")
+    args = parser.parse_args()
+    smoke_checks()
+    if args.smoke:
+        print("冒烟检查通过", file=sys.stderr)
+        return
+    if args.quick:
+        args.min_time = 0.1
+        args.decisions = 3
+        args.iterations = 10
+        args.sizes = [size for size in args.sizes if size < 50]
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__ if np is not None else None,
+            "seed": args.seed,
+            "min_time": args.min_time,
+            "iterations": args.iterations,
+            "decisions": args.decisions,
+            "decision_time": args.decision_time,
+            "batch": args.batch,
+            "rollout_depth": args.rollout_depth,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": []
+    }
+    for grid_size in args.sizes:
+        for n_players in args.players:
+            case = bench_case(grid_size, n_players, args.seed, args)
+            report["results"].append(case)
+            print(f"{grid_size}x{grid_size} {n_players}人: "
+                  f"simulate {case['simulate']['ops_per_s']:.1f}/s, "
+                  f"get_action p50 {case['get_action']['p50_ms']:.1f}ms", file=sys.stderr)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        mismatched = mismatched_settings(report, baseline)
+        if mismatched:
+            sys.exit("无法比较: " + ", ".join(f"{key} {baseline['meta'].get(key)} -> {report['meta'][key]}"
+                                               for key in mismatched))
+        regressions = compare(report, baseline, args.tolerance)
+        for r in regressions:
+            print(f"回退: {r['grid_size']}x{r['grid_size']} {r['players']}人 {r['benchmark']}.{r['metric']} "
+                  f"{r['baseline']:.3f} -> {r['current']:.3f}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
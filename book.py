@@ -0,0 +1,85 @@
+"""开局库生成
+
+为若干随机河流布局离线生成开局库：从开局出发，轮到AI的局面用大迭代次数的MCTS搜索出最佳行动并沿它继续，
+轮到人类玩家的局面按先验权重展开最可能的若干个行动（两种收集行动总会展开）。
+局面按8种对称变换规范化后去重，结果写成server.OpeningBook的格式。
+
+用法:
+    python book.py --layouts 64 --turns 6 --iterations 5000 --workers 8 --output opening.tob
+"""
+import argparse
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from server import (LAYOUT_SEED_MASK, GameState, OpeningBook, canonical_key, encode_move, mcts_search,
+                    move_priors, root_statistics, transform_move)
+
+def build_layout(job):
+    """为一个布局生成条目，返回 {规范键: 行动编码}"""
+    grid_size, n_players, human_seats, layout_seed, max_turn, human_moves, iterations, search_seed = job
+    players = [f"P{i + 1}" for i in range(n_players)]
+    entries = {}
+    visited = set()
+    # 深度优先展开；每个局面都从开局重新走一遍，事件与实际对局一样由本局的随机数生成器产生
+    stack = [[]]
+    while stack:
+        path = stack.pop()
+        state = GameState(grid_size, players, seed=layout_seed)
+        state.check_and_trigger_events()
+        for player, move in path:
+            state.apply_move(player, move)
+        if state.turn >= max_turn or state.is_game_over():
+            continue
+        key, t = canonical_key(state)
+        if key in visited:
+            continue
+        visited.add(key)
+        seat = state.turn % n_players
+        player = players[seat]
+        if seat in human_seats:
+            moves = state.available_moves(player)
+            weights = move_priors(state, player, moves)
+            ranked = sorted(range(len(moves)), key=lambda i: -weights[i])
+            chosen = {moves[i] for i in ranked[:human_moves]}
+            chosen.update([("collect_wood", None), ("collect_gold", None)])
+            for move in chosen:
+                stack.append(path + [(player, move)])
+            continue
+        random.seed(search_seed ^ key)
+        statistics = root_statistics(mcts_search(state, player, iterations))
+        move = max(statistics, key=lambda m: statistics[m][0])
+        entries[key] = encode_move(transform_move(move, grid_size, t), grid_size)
+        stack.append(path + [(player, move)])
+    return entries
+
+def main():
+    parser = argparse.ArgumentParser(description="生成开局库")
+    parser.add_argument("--grid-size", type=int, default=9)
+    parser.add_argument("--players", type=int, default=3, help="每局的玩家数（服务器为1个人类加2个AI）")
+    parser.add_argument("--human-seats", type=int, nargs="+", default=[0], help="人类玩家的座位序号")
+    parser.add_argument("--layouts", type=int, default=32, help="河流布局数")
+    parser.add_argument("--turns", type=int, default=6, help="覆盖的回合数（行动步数）")
+    parser.add_argument("--human-moves", type=int, default=6, help="人类玩家每步展开的行动数（另加两种收集）")
+    parser.add_argument("--iterations", type=int, default=5000, help="AI局面的搜索迭代次数")
+    parser.add_argument("--workers", type=int, default=None, help="工作进程数，默认为CPU核数")
+    parser.add_argument("--seed", type=int, default=12345)
+    parser.add_argument("--output", default="opening.tob")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    seeds = [rng.getrandbits(64) & LAYOUT_SEED_MASK for _ in range(args.layouts)]
+    jobs = [(args.grid_size, args.players, set(args.human_seats), seed, args.turns, args.human_moves,
+             args.iterations, rng.getrandbits(64)) for seed in seeds]
+    entries = {}
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for i, layout_entries in enumerate(pool.map(build_layout, jobs), 1):
+            entries.update(layout_entries)
+            print(f"{i}/{len(jobs)} 个布局, {len(entries)} 个条目, {time.perf_counter() - started:.0f}s",
+                  file=sys.stderr)
+    OpeningBook.save(args.output, entries, [(args.grid_size, args.players, seed) for seed in seeds], args.turns)
+
+if __name__ == '__main__':
+    main()
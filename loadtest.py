@@ -0,0 +1,240 @@
+"""Socket.IO负载测试
+
+在同一进程内用Flask-SocketIO的测试客户端模拟多个玩家，按真实协议（connect / start_game / move）进行对局，
+玩家数按阶段逐步增加，统计每个阶段行动的往返延迟分位数、吞吐量和服务器CPU占用，不需要网络和浏览器。
+
+每个模拟玩家独占一个房间（可以另加观战者），思考think_time秒后随机收集资源或点击随机格子，
+游戏结束后重新开始。测量三种延迟：
+    move    emit('move')到处理函数返回
+    ack     emit('move')到收到自己行动后的状态更新
+    turn    emit('move')到AI回合全部结束、重新轮到自己（或游戏结束）
+CPU占用为整个进程（服务器处理函数、AI后台任务以及模拟客户端本身）的CPU时间 / 墙钟时间，100%为一个核。
+
+用法:
+    python loadtest.py --ramp 1 5 10 50 100 200 --stage-seconds 30 --ai-think-ms 200 --output load.json
+    python loadtest.py --ramp 1 10 --spectators 5 --binary
+"""
+import argparse
+import json
+import random
+import statistics
+import struct
+import sys
+import threading
+import time
+
+import server
+from server import WIRE_HAS_MESSAGE, app, socketio
+
+# 状态帧的帧头（见server.py中的_WIRE_HEADER），只解析当前玩家和消息标志
+_FRAME_HEADER = struct.Struct("<BIIHBBBB")
+
+class Recorder:
+    """各模拟玩家共享的计时记录，每条为 (完成时刻, 类别, 秒)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+        self.errors = 0
+        self.games = 0
+        self.frames = 0
+        self.frame_bytes = 0
+
+    def add(self, kind, seconds):
+        with self.lock:
+            self.samples.append((time.perf_counter(), kind, seconds))
+
+    def count(self, errors=0, games=0, frames=0, frame_bytes=0):
+        with self.lock:
+            self.errors += errors
+            self.games += games
+            self.frames += frames
+            self.frame_bytes += frame_bytes
+
+    def totals(self):
+        with self.lock:
+            return {"errors": self.errors, "games": self.games, "frames": self.frames, "frame_bytes": self.frame_bytes}
+
+def message_size(message):
+    args = message["args"]
+    if args and isinstance(args[0], (bytes, bytearray)):
+        return len(args[0])
+    return len(json.dumps(args, ensure_ascii=False).encode("utf-8"))
+
+class SimulatedPlayer(threading.Thread):
+    def __init__(self, index, args, recorder, stop):
+        super().__init__(name=f"player-{index}", daemon=True)
+        self.index = index
+        self.args = args
+        self.recorder = recorder
+        self.stop = stop
+        self.rng = random.Random(args.seed + index)
+        self.my_turn = False
+        self.game_over = False
+        self.state_updates = 0  # 收到的状态更新数，用于判断行动是否已得到回应
+
+    def connect(self):
+        query = f"room=load-{self.index}" + ("&wire=binary" if self.args.binary else "")
+        return socketio.test_client(app, query_string=query)
+
+    def receive(self, client):
+        """处理收到的消息，更新是否轮到自己"""
+        messages = client.get_received()
+        frame_bytes = 0
+        for message in messages:
+            name, args = message["name"], message["args"]
+            frame_bytes += message_size(message)
+            if name == "game_over":
+                self.game_over = True
+                self.my_turn = False
+            elif name == "frame":
+                _, _, _, _, _, _, current, flags = _FRAME_HEADER.unpack_from(args[0], 0)
+                # 玩家顺序为 [player, AI1, AI2]，序号0是自己
+                self.my_turn = current == 0 and not flags & WIRE_HAS_MESSAGE
+                self.state_updates += 1
+            elif name in ("game_started", "update", "patch"):
+                data = args[0]
+                self.my_turn = data.get("currentPlayer") == "player" and not data.get("message")
+                self.state_updates += 1
+            elif name == "error":
+                self.recorder.count(errors=1)
+        self.recorder.count(frames=len(messages), frame_bytes=frame_bytes)
+
+    def wait(self, client, spectators, done, timeout=120.0):
+        deadline = time.perf_counter() + timeout
+        while not self.stop.is_set() and time.perf_counter() < deadline:
+            self.receive(client)
+            for spectator in spectators:
+                self.drain(spectator)
+            if done():
+                return True
+            time.sleep(0.002)
+        return False
+
+    def drain(self, client):
+        messages = client.get_received()
+        self.recorder.count(frames=len(messages), frame_bytes=sum(message_size(m) for m in messages))
+
+    def choose_move(self):
+        roll = self.rng.random()
+        if roll < 0.35:
+            return {"player": "player", "action": "collect_wood", "position": None}
+        if roll < 0.6:
+            return {"player": "player", "action": "collect_gold", "position": None}
+        # 与真人一样可能点到河流或已占领的格子，服务器会回复错误
+        return {"player": "player", "action": "occupy",
+                "position": [self.rng.randrange(9), self.rng.randrange(9)]}
+
+    def run(self):
+        client = self.connect()
+        spectators = [socketio.test_client(app, query_string=f"room=load-{self.index}" +
+                                           ("&wire=binary" if self.args.binary else ""))
+                      for _ in range(self.args.spectators)]
+        try:
+            while not self.stop.is_set():
+                self.game_over = False
+                self.my_turn = False
+                started = time.perf_counter()
+                client.emit("start_game")
+                self.recorder.add("start_game", time.perf_counter() - started)
+                if not self.wait(client, spectators, lambda: self.my_turn):
+                    continue
+                while not self.stop.is_set() and not self.game_over:
+                    # 人类玩家的思考时间，期间AI在后台思考
+                    if self.args.think_time:
+                        self.stop.wait(self.rng.uniform(0, 2 * self.args.think_time))
+                    seen = self.state_updates
+                    self.my_turn = False
+                    started = time.perf_counter()
+                    client.emit("move", self.choose_move())
+                    self.recorder.add("move", time.perf_counter() - started)
+                    if not self.wait(client, spectators, lambda: self.state_updates > seen or self.game_over):
+                        break
+                    self.recorder.add("ack", time.perf_counter() - started)
+                    if not self.wait(client, spectators, lambda: self.my_turn or self.game_over):
+                        break
+                    self.recorder.add("turn", time.perf_counter() - started)
+                self.recorder.count(games=int(self.game_over))
+        finally:
+            for c in [client] + spectators:
+                c.disconnect()
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {"count": len(ordered), "mean_ms": statistics.fmean(ordered) * 1000,
+            "p50_ms": pick(0.5), "p90_ms": pick(0.9), "p99_ms": pick(0.99), "max_ms": ordered[-1] * 1000}
+
+def main():
+    parser = argparse.ArgumentParser(description="Socket.IO负载测试")
+    parser.add_argument("--ramp", type=int, nargs="+", default=[1, 2, 5, 10, 20, 50, 100, 200],
+                        help="各阶段的同时在线玩家数")
+    parser.add_argument("--stage-seconds", type=float, default=20.0, help="每个阶段的测量时间")
+    parser.add_argument("--think-time", type=float, default=1.0, help="模拟玩家的平均思考时间（秒）")
+    parser.add_argument("--spectators", type=int, default=0, help="每个房间的观战者数")
+    parser.add_argument("--binary", action="store_true", help="使用二进制状态帧")
+    parser.add_argument("--ai-think-ms", type=int, default=None, help="覆盖服务器的AI思考时间（毫秒）")
+    parser.add_argument("--seed", type=int, default=12345)
+    parser.add_argument("--output", help="把各阶段结果写入JSON文件")
+    args = parser.parse_args()
+    if args.ai_think_ms is not None:
+        server.AI_THINK_MS = args.ai_think_ms
+
+    recorder = Recorder()
+    stop = threading.Event()
+    players = []
+    stages = []
+    print(f"{'玩家':>6}{'行动/s':>9}{'move p50':>10}{'p99':>8}{'ack p50':>9}{'p99':>8}"
+          f"{'turn p50':>10}{'p99':>9}{'CPU%':>7}{'帧/s':>8}{'KB/s':>8}", file=sys.stderr)
+    try:
+        for target in args.ramp:
+            while len(players) < target:
+                player = SimulatedPlayer(len(players), args, recorder, stop)
+                player.start()
+                players.append(player)
+            # 新玩家开局后再开始测量
+            time.sleep(min(1.0, args.stage_seconds / 4))
+            before = recorder.totals()
+            decisions = server.metrics.decisions
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            time.sleep(args.stage_seconds)
+            wall_end, cpu_end = time.perf_counter(), time.process_time()
+            after = recorder.totals()
+            elapsed = wall_end - wall_start
+            with recorder.lock:
+                window = [(kind, seconds) for at, kind, seconds in recorder.samples if wall_start <= at < wall_end]
+            stage = {
+                "players": target,
+                "seconds": elapsed,
+                "moves_per_s": sum(1 for kind, _ in window if kind == "move") / elapsed,
+                "ai_decisions_per_s": (server.metrics.decisions - decisions) / elapsed,
+                "cpu_percent": (cpu_end - cpu_start) / elapsed * 100,
+                "frames_per_s": (after["frames"] - before["frames"]) / elapsed,
+                "kbytes_per_s": (after["frame_bytes"] - before["frame_bytes"]) / elapsed / 1024,
+                "errors": after["errors"] - before["errors"],
+                "games_finished": after["games"] - before["games"],
+                "rooms": len(server.server.rooms),
+            }
+            for kind in ("move", "ack", "turn", "start_game"):
+                stage[kind] = percentiles([seconds for k, seconds in window if k == kind])
+            stages.append(stage)
+            def ms(kind, q):
+                return stage[kind].get(q, float("nan"))
+            print(f"{target:>6}{stage['moves_per_s']:>9.1f}{ms('move', 'p50_ms'):>10.1f}{ms('move', 'p99_ms'):>8.1f}"
+                  f"{ms('ack', 'p50_ms'):>9.1f}{ms('ack', 'p99_ms'):>8.1f}{ms('turn', 'p50_ms'):>10.0f}"
+                  f"{ms('turn', 'p99_ms'):>9.0f}{stage['cpu_percent']:>7.0f}{stage['frames_per_s']:>8.0f}"
+                  f"{stage['kbytes_per_s']:>8.1f}", file=sys.stderr)
+    finally:
+        stop.set()
+        for player in players:
+            player.join(timeout=5)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "stages": stages}, f, indent=2, ensure_ascii=False)
+
+if __name__ == '__main__':
+    main()
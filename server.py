@@ -1,11 +1,32 @@
-from flask import Flask, render_template, request
-from flask_socketio import SocketIO, emit
+from flask import Flask, Response, render_template, request
+from flask_socketio import SocketIO, emit, join_room
 import random
 import math
-from collections import defaultdict
-from dataclasses import dataclass
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, wait
+import bisect
+import functools
+import mmap
+import os
+import queue
+import struct
+import sys
+from array import array
+import threading
+from dataclasses import dataclass, fields
 from typing import Optional, Dict, List, Tuple, Any
 
+try:
+    import numpy as np
+except ImportError:  # NumPy是可选依赖，只有批量模拟需要
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # 没有fcntl的平台上，价值库的写入不做进程间加锁
+    fcntl = None
+
 @dataclass
 class Event:
     name: str
@@ -14,90 +35,403 @@ class Event:
     duration: int
     type: str
 
+# 所有可能的事件（只读目录，所有GameState共享）
+EVENT_CATALOG: Dict[str, Event] = {
+    # 资源事件
+    "resource_boom": Event(
+        name="资源繁荣",
+        description="资源收集效率提升",
+        effect={"resource_multiplier": 1.5},
+        duration=2,
+        type="resource"
+    ),
+    "gold_rush": Event(
+        name="金矿潮",
+        description="金币收集翻倍",
+        effect={"gold_multiplier": 2},
+        duration=1,
+        type="resource"
+    ),
+    "wood_blessing": Event(
+        name="森林祝福",
+        description="木材收集翻倍",
+        effect={"wood_multiplier": 2},
+        duration=1,
+        type="resource"
+    ),
+    # 建筑事件
+    "construction_discount": Event(
+        name="建筑折扣",
+        description="占领费用减少1个资源",
+        effect={"build_discount": 1},
+        duration=2,
+        type="building"
+    ),
+    "rapid_build": Event(
+        name="快速建造",
+        description="本回合可以连续占领两格",
+        effect={"extra_build": True},
+        duration=1,
+        type="building"
+    ),
+    # 地形事件
+    "river_shift": Event(
+        name="河流改道",
+        description="部分河流位置发生改变",
+        effect={"river_change": True},
+        duration=1,
+        type="terrain"
+    ),
+    # 特殊事件
+    "market_trade": Event(
+        name="市场交易",
+        description="可以1:1交换资源",
+        effect={"resource_trade": True},
+        duration=1,
+        type="special"
+    )
+}
+
+# 事件触发的权重参数：按事件类型的基础权重，以及前期/后期对特定类型的加成
+@dataclass(frozen=True)
+class EventWeights:
+    resource: float = 3.0  # 资源事件更常见
+    building: float = 2.0  # 建筑事件次之
+    other: float = 1.0
+    early_resource: float = 1.5  # 前5回合资源事件的加成
+    late_special: float = 1.5  # 第15回合起特殊事件的加成
+    extra_trigger: float = 0.5  # 已有一个活跃事件时再触发一个的概率
+
+    def base(self, event_type):
+        if event_type == "resource":
+            return self.resource
+        if event_type == "building":
+            return self.building
+        return self.other
+
+DEFAULT_EVENT_WEIGHTS = EventWeights()
+
+# 事件效果如何汇总到EventModifiers：效果名 -> (字段, 合并函数)。
+# 新事件只要使用已有的效果名就不需要改动行动结算；没有列出的效果（如resource_multiplier）不影响结算
+MODIFIER_RULES = {
+    "wood_multiplier": ("wood_multiplier", lambda a, b: a * b),
+    "gold_multiplier": ("gold_multiplier", lambda a, b: a * b),
+    "build_discount": ("build_discount", lambda a, b: a + b),
+    "extra_build": ("extra_build", lambda a, b: a or b),
+}
+
+class EventModifiers:
+    """生效事件的汇总修正，只在事件开始或结束时重新计算；创建后不再修改，副本之间直接共享"""
+    __slots__ = ("wood_multiplier", "gold_multiplier", "build_discount", "extra_build",
+                 "build_wood", "build_gold", "expires")
+
+    def __init__(self, events=()):
+        self.wood_multiplier = 1
+        self.gold_multiplier = 1
+        self.build_discount = 0
+        self.extra_build = False
+        self.expires = None  # 最早结束的事件的结束回合，到达时需要重新计算
+        for event in events:
+            for effect, value in event.effect.items():
+                rule = MODIFIER_RULES.get(effect)
+                if rule is not None:
+                    field, combine = rule
+                    setattr(self, field, combine(getattr(self, field), value))
+            if self.expires is None or event.duration < self.expires:
+                self.expires = event.duration
+        # 占领所需的木材和金币（基础2木材1金币，折扣不会使消耗变为收益）
+        self.build_wood = max(2 - self.build_discount, 0)
+        self.build_gold = max(1 - self.build_discount, 0)
+
+NO_MODIFIERS = EventModifiers()
+
+# 按 ((事件名, 结束回合), ...) 缓存的汇总修正；事件组合和结束回合的取值都很少，缓存规模有限
+_MODIFIER_CACHE: Dict[tuple, EventModifiers] = {(): NO_MODIFIERS}
+
+def modifiers_for(events):
+    events = tuple(events)
+    key = tuple((e.name, e.duration) for e in events)
+    modifiers = _MODIFIER_CACHE.get(key)
+    if modifiers is None:
+        modifiers = _MODIFIER_CACHE[key] = EventModifiers(events)
+    return modifiers
+
+# 按回合阶段预先算好权重的事件表，每种EventWeights编译一次
+class CompiledEvents:
+    def __init__(self, catalog: Dict[str, Event], event_weights: EventWeights):
+        self.events = list(catalog.values())
+        base = [event_weights.base(e.type) for e in self.events]
+        # 前5回合资源事件加成，第15回合起特殊事件加成，其余回合只用类型权重
+        self.early = [(e, w * event_weights.early_resource if e.type == "resource" else w)
+                      for e, w in zip(self.events, base)]
+        self.mid = list(zip(self.events, base))
+        self.late = [(e, w * event_weights.late_special if e.type == "special" else w)
+                     for e, w in zip(self.events, base)]
+        self._available: Dict[tuple, Tuple[List[Event], List[float]]] = {}
+
+    def weighted(self, current_round):
+        """当前回合阶段的 [(事件, 权重)]"""
+        if current_round <= 5:
+            return self.early
+        if current_round >= 15:
+            return self.late
+        return self.mid
+
+    def available(self, current_round, active):
+        """排除已生效事件后的 (事件列表, 权重列表)，按回合阶段和生效事件缓存"""
+        weighted = self.weighted(current_round)
+        key = (id(weighted), tuple(active))
+        entry = self._available.get(key)
+        if entry is None:
+            pairs = [(e, w) for e, w in weighted if e.name not in active]
+            entry = self._available[key] = ([e for e, _ in pairs], [w for _, w in pairs])
+        return entry
+
+_COMPILED_EVENTS: Dict[EventWeights, CompiledEvents] = {}
+
+def compiled_events(event_weights=DEFAULT_EVENT_WEIGHTS):
+    compiled = _COMPILED_EVENTS.get(event_weights)
+    if compiled is None:
+        compiled = _COMPILED_EVENTS[event_weights] = CompiledEvents(EVENT_CATALOG, event_weights)
+    return compiled
+
+# 棋盘格子编码：每格一个字节，玩家编号从PLAYER_BASE开始
+EMPTY = 0
+RIVER = 1
+PLAYER_BASE = 2
+
+# 棋盘的8种对称变换：变换t先按第2位转置，再按第0位左右翻转、第1位上下翻转
+# 随机种子的最高3位选择河流布局的变换，其余位决定河流和事件，同一布局的8种变换共享事件序列
+SYMMETRY_SHIFT = 61
+LAYOUT_SEED_MASK = (1 << SYMMETRY_SHIFT) - 1
+_SYMMETRIES: Dict[int, List[List[int]]] = {}
+
+def symmetries(grid_size):
+    """按棋盘大小缓存的8个格子置换，symmetries(n)[t][idx]为格子idx经变换t后的序号"""
+    tables = _SYMMETRIES.get(grid_size)
+    if tables is None:
+        tables = []
+        last = grid_size - 1
+        for t in range(8):
+            table = []
+            for idx in range(grid_size * grid_size):
+                x, y = idx % grid_size, idx // grid_size
+                if t & 4:
+                    x, y = y, x
+                if t & 1:
+                    x = last - x
+                if t & 2:
+                    y = last - y
+                table.append(y * grid_size + x)
+            tables.append(table)
+        _SYMMETRIES[grid_size] = tables
+    return tables
+
+# 按棋盘大小缓存的占领行动 ("occupy", (x, y))，下标为格子序号 y * grid_size + x
+_OCCUPY_MOVES: Dict[int, List[Tuple[str, Tuple[int, int]]]] = {}
+
+def occupy_moves(grid_size):
+    moves = _OCCUPY_MOVES.get(grid_size)
+    if moves is None:
+        moves = [("occupy", (idx % grid_size, idx // grid_size)) for idx in range(grid_size * grid_size)]
+        _OCCUPY_MOVES[grid_size] = moves
+    return moves
+
+# Zobrist哈希：各局面要素的64位键由splitmix64按(类别, 参数)确定性生成，不同进程间一致
+_MASK64 = (1 << 64) - 1
+_EVENT_INDEX = {event.name: i for i, event in enumerate(EVENT_CATALOG.values())}
+_RESOURCE_INDEX = {"wood": 0, "gold": 1}
+
+def mix64(x):
+    x = (x + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+def cell_key(idx, code):
+    return mix64((1 << 60) | (idx << 8) | code)
+
+def resource_key(code, resource, value):
+    return mix64((2 << 60) | (code << 40) | (_RESOURCE_INDEX[resource] << 32) | (value & 0xFFFFFFFF))
+
+def turn_key(turn):
+    return mix64((3 << 60) | turn)
+
+def event_key(name, duration):
+    return mix64((4 << 60) | (_EVENT_INDEX[name] << 16) | duration)
+
 app = Flask(__name__)
 socketio = SocketIO(app)
 
+# 二进制对局记录
+# 文件头: 魔数 b"TGL1", 棋盘大小(u16), 玩家数(u8), 各玩家名(u8长度 + UTF-8), 随机种子(u64), EventWeights的6个f64
+# 之后逐条记录，首字节低2位为类型: 0收集木材, 1收集金币, 2占领(后跟格子序号u16), 3事件(后跟事件序号u8和结束回合u8)；
+# 行动记录的2-5位为玩家序号，最高位为1表示行动失败（失败的行动也可能触发事件，重放时需要照样执行）；
+# 事件记录位于触发它的行动记录之前，第2位为1表示在行动之外直接调用check_and_trigger_events触发
+LOG_MAGIC = b"TGL1"
+LOG_ACTIONS = ("collect_wood", "collect_gold", "occupy")
+LOG_EVENT = 3
+LOG_STANDALONE = 0x04
+LOG_FAILED = 0x80
+LOG_NO_CELL = 0xFFFF  # 越界或格式错误的占领位置
+_LOG_ACTION_CODES = {action: code for code, action in enumerate(LOG_ACTIONS)}
+_LOG_WEIGHTS = struct.Struct("<6d")
+
+# 游戏状态事件的观察者接口，默认什么都不做（用于模拟和离线运行）
+class GameEventSink:
+    def event_triggered(self, state, event: Event, remaining: int):
+        """新事件触发，remaining为剩余持续回合数"""
+
+    def extra_build_available(self, state, player: str):
+        """玩家获得额外建造机会"""
+
+NULL_SINK = GameEventSink()
+
 # 游戏状态类
 class GameState:
-    def __init__(self, grid_size, players):
-        self.grid = [[None for _ in range(grid_size)] for _ in range(grid_size)]
+    def __init__(self, grid_size, players, sink: Optional[GameEventSink] = None,
+                 event_weights: Optional[EventWeights] = None, seed: Optional[int] = None):
+        self.board = bytearray(grid_size * grid_size)  # 一维棋盘，格子序号为 y * grid_size + x
         self.players = players
         self.resources = {p: {"wood": 10, "gold": 5} for p in players}
         self.turn = 0
+        self.started_turn = -1  # 已经处理过开始时事件的回合，失败的行动之后重新行动时不再处理
         self.grid_size = grid_size
         self.active_events: Dict[str, Event] = {}  # 当前生效的事件
+        self.modifiers = NO_MODIFIERS  # 生效事件的汇总修正，随事件开始和结束更新
         self.event_history: List[Event] = []  # 事件历史
+        self.moves: List[Tuple[str, Any]] = []  # 已成功执行的 (玩家, 行动)
+        self.sink = sink or NULL_SINK  # 状态事件的订阅者
+        self.event_weights = event_weights or DEFAULT_EVENT_WEIGHTS  # 事件触发权重，副本共享
+        # 河流和事件只使用本局的随机数生成器，由种子和行动记录即可重现整局
+        self.seed = seed if seed is not None else random.getrandbits(64)
+        self.rng = random.Random(self.seed & LAYOUT_SEED_MASK)
         
-        # 随机生成河流地块 (约10%的地块)
+        # 随机生成河流地块 (约10%的地块)，再按种子最高3位做对称变换
         river_count = int(grid_size * grid_size * 0.1)
-        river_positions = random.sample([(i, j) for i in range(grid_size) for j in range(grid_size)], river_count)
-        for i, j in river_positions:
-            self.grid[i][j] = "river"
-        
-        # 定义所有可能的事件
-        self.all_events = {
-            # 资源事件
-            "resource_boom": Event(
-                name="资源繁荣",
-                description="资源收集效率提升",
-                effect={"resource_multiplier": 1.5},
-                duration=2,
-                type="resource"
-            ),
-            "gold_rush": Event(
-                name="金矿潮",
-                description="金币收集翻倍",
-                effect={"gold_multiplier": 2},
-                duration=1,
-                type="resource"
-            ),
-            "wood_blessing": Event(
-                name="森林祝福",
-                description="木材收集翻倍",
-                effect={"wood_multiplier": 2},
-                duration=1,
-                type="resource"
-            ),
-            # 建筑事件
-            "construction_discount": Event(
-                name="建筑折扣",
-                description="占领费用减少1个资源",
-                effect={"build_discount": 1},
-                duration=2,
-                type="building"
-            ),
-            "rapid_build": Event(
-                name="快速建造",
-                description="本回合可以连续占领两格",
-                effect={"extra_build": True},
-                duration=1,
-                type="building"
-            ),
-            # 地形事件
-            "river_shift": Event(
-                name="河流改道",
-                description="部分河流位置发生改变",
-                effect={"river_change": True},
-                duration=1,
-                type="terrain"
-            ),
-            # 特殊事件
-            "market_trade": Event(
-                name="市场交易",
-                description="可以1:1交换资源",
-                effect={"resource_trade": True},
-                duration=1,
-                type="special"
-            )
-        }
+        river_positions = self.rng.sample(range(grid_size * grid_size), river_count)
+        symmetry = symmetries(grid_size)[self.seed >> SYMMETRY_SHIFT]
+        for idx in river_positions:
+            self.board[symmetry[idx]] = RIVER
+        
+        # 增量索引：空地集合、各玩家领地数，随apply_move同步更新
+        self.player_codes = {}
+        for i, p in enumerate(players):
+            self.player_codes.setdefault(p, PLAYER_BASE + i)
+        self.empty_cells = {idx for idx in range(grid_size * grid_size) if self.board[idx] == EMPTY}
+        self.territory = {p: 0 for p in players}
+        self.zobrist = self.compute_zobrist()  # 局面哈希，随apply_move增量更新
+        
+        # 所有事件共享同一份只读目录，不再为每个状态重建
+        self.all_events = EVENT_CATALOG
+        # 写时复制标记：为True时棋盘/resources/事件容器与其他副本共享
+        self._shared = False
+        
+        # 对局记录，只有实际对局记录，副本为None
+        self.log = bytearray(LOG_MAGIC)
+        self.log += struct.pack("<HB", grid_size, len(players))
+        for p in players:
+            name = p.encode("utf-8")
+            self.log += struct.pack("<B", len(name)) + name
+        self.log += struct.pack("<Q", self.seed)
+        self.log += _LOG_WEIGHTS.pack(*(getattr(self.event_weights, f.name) for f in fields(EventWeights)))
+
+    def compute_zobrist(self):
+        """从头计算局面哈希：棋盘、资源、回合数和生效的事件"""
+        h = turn_key(self.turn)
+        for idx, code in enumerate(self.board):
+            if code != EMPTY:
+                h ^= cell_key(idx, code)
+        for p, code in self.player_codes.items():
+            for resource, value in self.resources[p].items():
+                h ^= resource_key(code, resource, value)
+        for name, event in self.active_events.items():
+            h ^= event_key(name, event.duration)
+        return h
+
+    def _add_resource(self, player, resource, delta):
+        old = self.resources[player][resource]
+        self.resources[player][resource] = old + delta
+        code = self.player_codes[player]
+        self.zobrist ^= resource_key(code, resource, old) ^ resource_key(code, resource, old + delta)
+
+    def _refresh_modifiers(self):
+        self.modifiers = modifiers_for(self.active_events.values())
+
+    def event_modifiers(self, current_round=None):
+        """当前回合生效的汇总修正；有事件在本回合已到期（还未在大回合开始时移除）时重新计算"""
+        if current_round is None:
+            current_round = self.turn // len(self.players) + 1
+        modifiers = self.modifiers
+        if modifiers.expires is not None and modifiers.expires <= current_round:
+            modifiers = modifiers_for(e for e in self.active_events.values() if e.duration > current_round)
+        return modifiers
+
+    def _finish_move(self, player, move):
+        self.zobrist ^= turn_key(self.turn) ^ turn_key(self.turn + 1)
+        self.turn += 1
+        self.moves.append((player, move))
+        if self.log is not None:
+            self._log_move(player, move, False)
+
+    def _log_move(self, player, move, failed):
+        action, position = move
+        code = _LOG_ACTION_CODES.get(action)
+        if code is None:
+            # 未知行动和无效占领一样只会失败，记为无效占领即可重现
+            code, position = _LOG_ACTION_CODES["occupy"], None
+        self.log.append(code | self.players.index(player) << 2 | (LOG_FAILED if failed else 0))
+        if code == _LOG_ACTION_CODES["occupy"]:
+            cell = LOG_NO_CELL
+            try:
+                x, y = position
+                if isinstance(x, int) and isinstance(y, int) and 0 <= x < self.grid_size and 0 <= y < self.grid_size:
+                    cell = y * self.grid_size + x
+            except (TypeError, ValueError):
+                pass
+            self.log += struct.pack("<H", cell)
+
+    def _unshare(self):
+        """写入前复制与其他副本共享的容器"""
+        self.board = bytearray(self.board)
+        self.empty_cells = set(self.empty_cells)
+        self.territory = self.territory.copy()
+        self.resources = {p: r.copy() for p, r in self.resources.items()}
+        self.active_events = dict(self.active_events)
+        self.event_history = self.event_history.copy()
+        self.moves = self.moves.copy()
+        self._shared = False
+
+    @property
+    def grid(self):
+        """按前端格式返回二维网格：grid[y][x] 为 None、"river" 或玩家名"""
+        return self.board_grid(self.board)
+
+    def board_grid(self, board):
+        """把本局的棋盘（或它在某一时刻的副本）转换为前端格式的二维网格"""
+        names = [None, "river"] + [None] * len(self.players)
+        for p, code in self.player_codes.items():
+            names[code] = p
+        size = self.grid_size
+        return [[names[c] for c in board[y * size:(y + 1) * size]] for y in range(size)]
+
+    def can_occupy(self, player):
+        """player的资源是否足够占领；大回合开始时新触发的事件只会降低费用，足够时占领空地一定成功"""
+        modifiers = self.event_modifiers()
+        resources = self.resources[player]
+        return resources["wood"] >= modifiers.build_wood and resources["gold"] >= modifiers.build_gold
+
+    def executable_moves(self, player):
+        """available_moves中一定能执行的行动：资源不足时只有两种收集"""
+        if self.can_occupy(player):
+            return self.available_moves(player)
+        return [("collect_wood", None), ("collect_gold", None)]
 
     def available_moves(self, player):
         moves = [("collect_wood", None), ("collect_gold", None)]
-        for i in range(self.grid_size):
-            for j in range(self.grid_size):
-                # 只允许在空地块上建造
-                if self.grid[i][j] is None:
-                    moves.append(("occupy", (i, j)))
+        # 只允许在空地块上建造
+        occupy = occupy_moves(self.grid_size)
+        moves.extend([occupy[idx] for idx in self.empty_cells])
         return moves
 
     def is_valid_position(self, position):
@@ -106,56 +440,47 @@ class GameState:
         if not (0 <= x < self.grid_size and 0 <= y < self.grid_size):
             return False
         # 检查是否是空地块（不是河流也不是已占领）
-        return self.grid[y][x] is None
+        return self.board[y * self.grid_size + x] == EMPTY
 
     def check_and_trigger_events(self) -> Optional[Event]:
         """检查并触发随机事件，返回触发的事件"""
+        new_event = self._trigger_event()
+        if new_event:
+            self._refresh_modifiers()
+        return new_event
+
+    def _trigger_event(self) -> Optional[Event]:
+        """check_and_trigger_events的主体，不更新汇总修正（apply_move在大回合开始时统一更新）"""
         current_round = (self.turn // len(self.players)) + 1
         
+        event_weights = self.event_weights
+        
         # 如果没有活跃事件，100%触发新事件
-        # 如果有活跃事件，50%概率触发额外事件
+        # 如果有活跃事件，按extra_trigger的概率（默认50%）触发额外事件
         should_trigger = (len(self.active_events) == 0 or
-                        (len(self.active_events) < 2 and random.random() < 0.5))
+                        (len(self.active_events) < 2 and self.rng.random() < event_weights.extra_trigger))
         
         if should_trigger:
-            # 根据事件类型和当前回合设置权重
-            available_events = []
-            weights = []
-            
-            for event in self.all_events.values():
-                if event.name not in self.active_events:
-                    available_events.append(event)
-                    base_weight = 1.0
-                    
-                    # 根据事件类型设置基础权重
-                    if event.type == "resource":
-                        base_weight = 3.0  # 资源事件更常见
-                    elif event.type == "building":
-                        base_weight = 2.0  # 建筑事件次之
-                    
-                    # 根据回合数调整权重
-                    if current_round <= 5:
-                        # 前5回合倾向于触发资源事件
-                        if event.type == "resource":
-                            base_weight *= 1.5
-                    elif current_round >= 15:
-                        # 后期倾向于触发特殊事件
-                        if event.type == "special":
-                            base_weight *= 1.5
-                    
-                    weights.append(base_weight)
+            # 当前回合阶段预先算好的权重，排除已生效的事件
+            available_events, weights = compiled_events(event_weights).available(current_round, self.active_events)
             
             if available_events:
-                new_event = random.choices(available_events, weights=weights, k=1)[0]
+                if self._shared:
+                    self._unshare()
+                new_event = self.rng.choices(available_events, weights=weights, k=1)[0]
                 event_instance = Event(
                     name=new_event.name,
                     description=new_event.description,
                     effect=new_event.effect.copy(),
-                    duration=current_round + random.randint(2, 3),  # 持续到指定回合
+                    duration=current_round + self.rng.randint(2, 3),  # 持续到指定回合
                     type=new_event.type
                 )
                 self.active_events[new_event.name] = event_instance
                 self.event_history.append(event_instance)
+                self.zobrist ^= event_key(event_instance.name, event_instance.duration)
+                if self.log is not None:
+                    self.log += struct.pack("<BBB", LOG_EVENT | LOG_STANDALONE, _EVENT_INDEX[new_event.name],
+                                            event_instance.duration)
                 return event_instance
         
         return None
@@ -163,432 +488,2156 @@ class GameState:
     def apply_event_effects(self, action: str, player: str, resources_delta: Dict[str, int]) -> Dict[str, int]:
         """应用事件效果到资源变化上"""
         modified_delta = resources_delta.copy()
-        current_round = (self.turn // len(self.players)) + 1
-        
         # 只应用未过期的事件效果
-        for event in self.active_events.values():
-            if event.duration > current_round:  # 检查事件是否在当前回合仍然有效
-                if action == "collect_wood" and "wood_multiplier" in event.effect:
-                    modified_delta["wood"] = int(modified_delta["wood"] * event.effect["wood_multiplier"])
-                elif action == "collect_gold" and "gold_multiplier" in event.effect:
-                    modified_delta["gold"] = int(modified_delta["gold"] * event.effect["gold_multiplier"])
-                elif action == "occupy" and "build_discount" in event.effect:
-                    for resource in modified_delta:
-                        if modified_delta[resource] < 0:  # 只对消耗进行折扣
-                            modified_delta[resource] += event.effect["build_discount"]
-                            modified_delta[resource] = min(modified_delta[resource], 0)  # 确保不会变成正数
-        
+        modifiers = self.event_modifiers()
+        if action == "collect_wood":
+            modified_delta["wood"] = int(modified_delta["wood"] * modifiers.wood_multiplier)
+        elif action == "collect_gold":
+            modified_delta["gold"] = int(modified_delta["gold"] * modifiers.gold_multiplier)
+        elif action == "occupy" and modifiers.build_discount:
+            for resource in modified_delta:
+                if modified_delta[resource] < 0:  # 只对消耗进行折扣
+                    modified_delta[resource] = min(modified_delta[resource] + modifiers.build_discount, 0)
         return modified_delta
 
-    def apply_move(self, player, move):
-        action, position = move
+    def start_turn(self):
+        """结算本回合开始时的事件，返回当前大回合数；apply_move会先调用它
         
+        大回合开始时移除过期事件并检查新事件，每回合只结算一次：
+        同一回合中行动失败后重新行动，不会再次触发事件。
+        """
         # 计算当前大回合数
         current_round = (self.turn // len(self.players)) + 1
+        if self.turn % len(self.players) != 0 or self.started_turn == self.turn:
+            return current_round
+        if self._shared:
+            self._unshare()
+        self.started_turn = self.turn
         
-        # 在每个大回合开始时检查事件
-        if self.turn % len(self.players) == 0:
-            # 移除过期事件（基于大回合数）
-            expired_events = [event_id for event_id, event in self.active_events.items()
-                            if event.duration <= current_round]
-            for event_id in expired_events:
-                del self.active_events[event_id]
-            
-            # 触发新事件
-            new_event = self.check_and_trigger_events()
-            if new_event:
-                # 设置事件结束回合数（当前回合数+持续回合数）
-                new_event.duration = current_round + random.randint(2, 3)
-                # 通过socket发送事件信息到前端
-                emit('event_triggered', {
-                    'name': new_event.name,
-                    'description': new_event.description,
-                    'type': new_event.type,
-                    'duration': new_event.duration - current_round  # 发送剩余持续回合数
-                }, broadcast=True)
-        
-        # 处理不同的行动
+        # 移除过期事件（基于大回合数）
+        expired_events = [event_id for event_id, event in self.active_events.items()
+                        if event.duration <= current_round]
+        for event_id in expired_events:
+            self.zobrist ^= event_key(event_id, self.active_events[event_id].duration)
+            del self.active_events[event_id]
+        if expired_events:
+            self._refresh_modifiers()
+        
+        # 触发新事件
+        new_event = self._trigger_event()
+        if new_event:
+            # 设置事件结束回合数（当前回合数+持续回合数）
+            self.zobrist ^= event_key(new_event.name, new_event.duration)
+            new_event.duration = current_round + self.rng.randint(2, 3)
+            self.zobrist ^= event_key(new_event.name, new_event.duration)
+            self._refresh_modifiers()
+            if self.log is not None:
+                # 改写刚写入的事件记录：由行动触发，结束回合以此处为准
+                self.log[-3] = LOG_EVENT
+                self.log[-1] = new_event.duration
+            # 通知订阅者（线上游戏会转发到前端）
+            self.sink.event_triggered(self, new_event, new_event.duration - current_round)
+        return current_round
+
+    def apply_move(self, player, move):
+        action, position = move
+        current_round = self.start_turn()
+        if self._shared:
+            self._unshare()
+        
+        # 处理不同的行动：事件效果取自汇总修正（与apply_event_effects的结果相同）
+        modifiers = self.event_modifiers(current_round)
         if action == "collect_wood":
-            resources_delta = {"wood": 3, "gold": 0}
-            modified_delta = self.apply_event_effects(action, player, resources_delta)
-            self.resources[player]["wood"] += modified_delta["wood"]
-            self.turn += 1
+            self._add_resource(player, "wood", int(3 * modifiers.wood_multiplier))
+            self._finish_move(player, move)
             return True
             
         elif action == "collect_gold":
-            resources_delta = {"wood": 0, "gold": 2}
-            modified_delta = self.apply_event_effects(action, player, resources_delta)
-            self.resources[player]["gold"] += modified_delta["gold"]
-            self.turn += 1
+            self._add_resource(player, "gold", int(2 * modifiers.gold_multiplier))
+            self._finish_move(player, move)
             return True
             
         elif action == "occupy":
             x, y = position
-            resources_delta = {"wood": -2, "gold": -1}
-            modified_delta = self.apply_event_effects(action, player, resources_delta)
-            
-            required_wood = abs(modified_delta["wood"])
-            required_gold = abs(modified_delta["gold"])
+            required_wood = modifiers.build_wood
+            required_gold = modifiers.build_gold
             
             if (self.is_valid_position((x, y)) and
                 self.resources[player]["wood"] >= required_wood and
                 self.resources[player]["gold"] >= required_gold):
                 
-                self.resources[player]["wood"] += modified_delta["wood"]
-                self.resources[player]["gold"] += modified_delta["gold"]
-                self.grid[y][x] = player
-                self.turn += 1
+                self._add_resource(player, "wood", -required_wood)
+                self._add_resource(player, "gold", -required_gold)
+                idx = y * self.grid_size + x
+                self.board[idx] = self.player_codes[player]
+                self.zobrist ^= cell_key(idx, self.board[idx])
+                self.empty_cells.discard(idx)
+                self.territory[player] += 1
                 
                 # 处理特殊事件效果
-                extra_build = any(event.effect.get("extra_build", False)
-                                for event in self.active_events.values())
-                if extra_build:
-                    emit('extra_build_available', {'player': player}, broadcast=True)
+                if modifiers.extra_build:
+                    self.sink.extra_build_available(self, player)
                 
+                self._finish_move(player, move)
                 return True
+            if self.log is not None:
+                self._log_move(player, move, True)
             return False  # 位置无效或资源不足时返回False
-            
+        
+        if self.log is not None:
+            self._log_move(player, move, True)
         return False  # 未知action时返回False
 
     def calculate_score(self, player):
         # 只计算非河流地块的占领分数
-        territory_score = sum(1 for row in self.grid for cell in row if cell == player) * 2  # 领地分数权重加倍
+        territory_score = self.territory[player] * 2  # 领地分数权重加倍
         resource_score = (self.resources[player]["wood"] + self.resources[player]["gold"]) * 0.1  # 资源分数权重降低
         return territory_score + resource_score
 
     def is_game_over(self):
         current_round = (self.turn // len(self.players)) + 1
         # 只有在达到20回合或所有非河流格子都被占领时才结束
-        all_occupied = all(self.grid[i][j] is not None and self.grid[i][j] != "river"
-                         for i in range(self.grid_size)
-                         for j in range(self.grid_size))
-        return current_round > 20 or all_occupied
+        return current_round > 20 or not self.empty_cells
 
     def get_winner(self):
         scores = {p: self.calculate_score(p) for p in self.players}
         return max(scores, key=scores.get)
 
     def copy(self):
-        new_state = GameState(self.grid_size, self.players)
-        new_state.grid = [row[:] for row in self.grid]
-        new_state.resources = {p: r.copy() for p, r in self.resources.items()}
+        # 跳过构造函数：不重新生成河流，也不重建事件目录
+        new_state = GameState.__new__(GameState)
+        new_state.grid_size = self.grid_size
+        new_state.players = self.players
         new_state.turn = self.turn
-        new_state.active_events = {k: Event(
-            name=v.name,
-            description=v.description,
-            effect=v.effect.copy(),
-            duration=v.duration,
-            type=v.type
-        ) for k, v in self.active_events.items()}
-        new_state.event_history = self.event_history.copy()
+        new_state.started_turn = self.started_turn
+        new_state.zobrist = self.zobrist
+        new_state.all_events = self.all_events
+        new_state.event_weights = self.event_weights
+        new_state.seed = self.seed
+        # 副本用于搜索：使用全局随机数，不消耗本局的随机序列，也不写对局记录
+        new_state.rng = random
+        new_state.log = None
+        # 副本用于模拟，不向任何订阅者发送事件
+        new_state.sink = NULL_SINK
+        # 容器先共享，任一方写入时再复制（事件实例创建后不再修改，可直接共享）
+        new_state.board = self.board
+        new_state.player_codes = self.player_codes
+        new_state.empty_cells = self.empty_cells
+        new_state.territory = self.territory
+        new_state.resources = self.resources
+        new_state.active_events = self.active_events
+        new_state.modifiers = self.modifiers
+        new_state.event_history = self.event_history
+        new_state.moves = self.moves
+        new_state._shared = True
+        self._shared = True
         return new_state
 
-# MCTS节点
+    def __getstate__(self):
+        # 传给工作进程（根并行）时不带随机数生成器、订阅者和对局记录，在工作进程中与副本相同
+        state = self.__dict__.copy()
+        del state["rng"], state["sink"], state["log"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rng = random
+        self.sink = NULL_SINK
+        self.log = None
+        self._shared = False  # 反序列化得到的容器是独立的
+
+def _read_log_header(data):
+    """解析对局记录的文件头，返回 (文件头, 第一条记录的偏移)"""
+    if bytes(data[:4]) != LOG_MAGIC:
+        raise ValueError("不是对局记录")
+    grid_size, n_players = struct.unpack_from("<HB", data, 4)
+    offset = 7
+    players = []
+    for _ in range(n_players):
+        length = data[offset]
+        players.append(bytes(data[offset + 1:offset + 1 + length]).decode("utf-8"))
+        offset += 1 + length
+    seed, = struct.unpack_from("<Q", data, offset)
+    offset += 8
+    weights = EventWeights(*_LOG_WEIGHTS.unpack_from(data, offset))
+    offset += _LOG_WEIGHTS.size
+    return {"grid_size": grid_size, "players": players, "seed": seed, "event_weights": weights}, offset
+
+def read_game_log(data):
+    """解析对局记录，返回 (文件头, 记录列表)
+    
+    行动记录为 ("move", 玩家, 行动, 是否失败)，
+    事件记录为 ("event", 事件ID, 结束回合, 是否在行动之外触发)。
+    """
+    header, offset = _read_log_header(data)
+    event_names = list(EVENT_CATALOG)
+    grid_size = header["grid_size"]
+    records = []
+    while offset < len(data):
+        tag = data[offset]
+        code = tag & 0x03
+        if code == LOG_EVENT:
+            records.append(("event", event_names[data[offset + 1]], data[offset + 2], bool(tag & LOG_STANDALONE)))
+            offset += 3
+            continue
+        player = header["players"][(tag >> 2) & 0x0F]
+        position = None
+        offset += 1
+        if code == _LOG_ACTION_CODES["occupy"]:
+            cell, = struct.unpack_from("<H", data, offset)
+            offset += 2
+            position = (-1, -1) if cell == LOG_NO_CELL else (cell % grid_size, cell // grid_size)
+        records.append(("move", player, (LOG_ACTIONS[code], position), bool(tag & LOG_FAILED)))
+    return header, records
+
+def replay(data, turn=None, sink: Optional[GameEventSink] = None, visit=None):
+    """由对局记录重建局面，不需要Socket.IO；turn不为None时快进到第turn步行动之前为止
+    
+    事件由种子重新生成，并与记录中的事件逐一核对。对局开始时在行动之外触发的事件
+    （如start_game中的check_and_trigger_events）也按记录的位置重新触发。
+    visit不为None时在每个成功的行动之后以当前局面调用。
+    """
+    header, records = read_game_log(data)
+    state = GameState(header["grid_size"], header["players"], sink, header["event_weights"], header["seed"])
+    expected = []  # 记录中的 (事件名, 结束回合)
+    checked = 0
+    for record in records:
+        if turn is not None and state.turn >= turn:
+            break
+        if record[0] == "event":
+            _, event_id, duration, standalone = record
+            expected.append((EVENT_CATALOG[event_id].name, duration))
+            if standalone:
+                state.check_and_trigger_events()
+        else:
+            _, player, move, failed = record
+            if state.apply_move(player, move) == failed:
+                raise ValueError(f"重放在第{state.turn}步的行动结果与记录不一致")
+            if visit is not None and not failed:
+                visit(state)
+        for event in state.event_history[checked:]:
+            if checked >= len(expected) or expected[checked] != (event.name, event.duration):
+                raise ValueError(f"重放在第{state.turn}步触发的事件与记录不一致")
+            checked += 1
+    return state
+
+# AI的可调参数：UCT探索系数、探索率、模拟策略的行动权重和价值库的用法
+@dataclass(frozen=True)
+class AIConfig:
+    exploration: float = 1.4  # UCT探索系数
+    epsilon: float = 0.2  # 随机行动的概率
+    rollout_wood: float = 2.0  # 木材少于6时收集木材的权重
+    rollout_gold: float = 2.0  # 金币少于4时收集金币的权重
+    rollout_occupy: float = 3.0  # 资源足够时占领的权重
+    rollout_other: float = 1.0  # 其余行动的权重
+    progressive_widening: bool = True  # False时一次展开全部行动并用UCT选择
+    c_puct: float = 1.0  # PUCT探索系数
+    widening_base: float = 1.0  # 访问n次的节点最多展开 widening_base * n ** widening_exponent 个子节点
+    widening_exponent: float = 0.5
+    rollout_depth: Optional[int] = None  # 模拟走这么多步后用evaluate估分，None表示走到游戏结束（不影响NumPy批量模拟）
+    event_weights: Optional[EventWeights] = None  # 搜索中假定的事件权重，None表示沿用实际局面的
+    value_prior_visits: int = 8  # 价值库中的记录最多折算成这么多次虚拟访问，0表示不用作先验
+    value_cutoff_visits: Optional[int] = 32  # 价值库中样本数达到该值的局面直接用记录的得分代替模拟，None表示不截断
+
+DEFAULT_AI_CONFIG = AIConfig()
+
+# 一次搜索的统计，各阶段耗时单位为秒
+@dataclass
+class SearchStats:
+    iterations: int = 0
+    selection_time: float = 0.0
+    expansion_time: float = 0.0
+    simulation_time: float = 0.0
+    backpropagation_time: float = 0.0
+    nodes_created: int = 0
+    tree_size: int = 0
+    max_depth: int = 0
+    rollouts: int = 0
+    rollout_plies: int = 0
+    state_copies: int = 0
+    value_cutoffs: int = 0  # 用价值库记录代替模拟的次数
+
+    def merge(self, other: "SearchStats"):
+        """累加另一次搜索（如根并行的其他进程）的统计"""
+        for field in fields(self):
+            if field.name == "max_depth":
+                self.max_depth = max(self.max_depth, other.max_depth)
+            else:
+                setattr(self, field.name, getattr(self, field.name) + getattr(other, field.name))
+
+# 节点统计，可由置换表在相同局面的节点间共享
+class NodeStats:
+    __slots__ = ("visits", "wins")
+
+    def __init__(self):
+        self.visits = 0
+        self.wins = 0
+
+# 置换表：以局面Zobrist哈希为键的有界表，超出容量时淘汰最久未使用的条目
+class TranspositionTable:
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.entries: "OrderedDict[int, Any]" = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        value = self.entries.get(key)
+        if value is None:
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def node_stats(self, key):
+        """返回局面的共享统计，不存在时创建"""
+        stats = self.get(key)
+        if stats is None:
+            stats = NodeStats()
+            self.put(key, stats)
+        return stats
+
+def store_key(state):
+    """价值库的键：局面哈希再区分棋盘大小和玩家数（不同尺寸的棋盘会复用相同的格子键）"""
+    return (state.zobrist ^ mix64((6 << 60) | (state.grid_size << 8) | len(state.players))) or 1
+
+# 价值库文件
+# 文件头32字节: 魔数 b"TVS1", 槽位数(u32, 2的幂), 每条记录的值个数(u32), 记录长度(u32), 其余填0
+# 之后为定长记录: 键(u64, 0表示空槽), 样本数(u32), 各座位的平均归一化终局得分(4个f32), 填充4字节
+VALUE_STORE_MAGIC = b"TVS1"
+VALUE_STORE_SEATS = 4  # 只记录不超过4人的对局
+VALUE_STORE_PROBES = 8  # 线性探测的最大步数，探测范围内没有空槽时替换样本数最少的记录
+VALUE_STORE_MAX_COUNT = 1000  # 样本数上限，之后新对局按固定权重更新均值，旧经验逐渐淡出
+_VALUE_HEADER = struct.Struct("<4sIII16x")
+_VALUE_RECORD = struct.Struct(f"<QI{VALUE_STORE_SEATS}f4x")
+
+class ValueStore:
+    """持久化的局面价值库：以store_key为键的开放寻址哈希表，存放在内存映射的定长记录文件中
+
+    第一次访问时才打开文件（不存在时由learn创建）；读取直接访问映射的页面，不把文件读进内存，
+    多个服务器进程可以同时打开同一个文件。写入时对文件加排他锁，多个进程都可以写入；
+    读取不加锁，可能读到正在更新的记录，对估值来说可以接受。
+    """
+
+    def __init__(self, path, capacity=1 << 20):
+        if capacity & (capacity - 1):
+            raise ValueError("capacity必须是2的幂")
+        self.path = path
+        self.capacity = capacity  # 新建文件的槽位数，已有文件以文件头为准
+        self._map = None
+        self._fd = -1
+        self._mask = 0
+        self._checked = None  # 上次发现文件不存在的时间，避免每次查找都访问文件系统
+
+    def __getstate__(self):
+        # 传给工作进程时只传路径，在工作进程中重新映射
+        return {"path": self.path, "capacity": self.capacity}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["capacity"])
+
+    def _open(self, create=False):
+        if self._map is not None:
+            return self._map
+        if not create and self._checked is not None and time.monotonic() - self._checked < 1.0:
+            return None
+        try:
+            if create:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | (os.O_CREAT if create else 0))
+        except OSError:
+            if create:
+                raise
+            self._checked = time.monotonic()  # 文件不存在或无权访问，按空库处理
+            return None
+        try:
+            if create and fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)  # 避免两个进程同时初始化新文件
+            if os.fstat(fd).st_size == 0:
+                if not create:
+                    self._checked = time.monotonic()
+                    os.close(fd)
+                    return None
+                # 稀疏文件：没写过的槽位不占磁盘
+                os.ftruncate(fd, _VALUE_HEADER.size + self.capacity * _VALUE_RECORD.size)
+                os.pwrite(fd, _VALUE_HEADER.pack(VALUE_STORE_MAGIC, self.capacity, VALUE_STORE_SEATS,
+                                                 _VALUE_RECORD.size), 0)
+            data = mmap.mmap(fd, 0)
+        except BaseException:
+            os.close(fd)
+            raise
+        magic, capacity, seats, record_size = _VALUE_HEADER.unpack_from(data, 0)
+        if magic == bytes(4) and not create:
+            # 另一个进程正在初始化文件
+            data.close()
+            os.close(fd)
+            self._checked = time.monotonic()
+            return None
+        if (magic != VALUE_STORE_MAGIC or seats != VALUE_STORE_SEATS or record_size != _VALUE_RECORD.size or
+                capacity & (capacity - 1) or len(data) < _VALUE_HEADER.size + capacity * record_size):
+            data.close()
+            os.close(fd)
+            raise ValueError(f"{self.path}不是有效的价值库文件")
+        self._fd = fd  # 保持打开，写入时用于加锁
+        self._map = data
+        self._mask = capacity - 1
+        return data
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            os.close(self._fd)
+            self._map = None
+
+    def get(self, key):
+        """返回 (样本数, 各座位的平均归一化得分)，没有记录时返回None"""
+        data = self._open()
+        if data is None:
+            return None
+        mask = self._mask
+        for i in range(VALUE_STORE_PROBES):
+            offset = _VALUE_HEADER.size + ((key + i) & mask) * _VALUE_RECORD.size
+            record = _VALUE_RECORD.unpack_from(data, offset)
+            if record[0] == key:
+                return record[1], record[2:]
+            if record[0] == 0:
+                return None
+        return None
+
+    def _update(self, data, key, values):
+        mask = self._mask
+        victim = None
+        for i in range(VALUE_STORE_PROBES):
+            offset = _VALUE_HEADER.size + ((key + i) & mask) * _VALUE_RECORD.size
+            record = _VALUE_RECORD.unpack_from(data, offset)
+            if record[0] == key:
+                count = record[1] + 1
+                weight = 1 / min(count, VALUE_STORE_MAX_COUNT)
+                means = [old + (new - old) * weight for old, new in zip(record[2:], values)]
+                _VALUE_RECORD.pack_into(data, offset, key, min(count, VALUE_STORE_MAX_COUNT), *means)
+                return
+            if record[0] == 0:
+                victim = offset
+                break
+            if victim is None or record[1] < victim_count:
+                victim, victim_count = offset, record[1]
+        _VALUE_RECORD.pack_into(data, victim, key, 1, *values)
+
+    def learn(self, log):
+        """由一局完整的对局记录学习：对局中每个行动后的局面记入各座位的终局归一化得分
+
+        返回记入的局面数；对局未结束或超过VALUE_STORE_SEATS人时不记录。
+        """
+        positions = []
+        state = replay(log, visit=lambda s: positions.append(store_key(s)))
+        if not state.is_game_over() or len(state.players) > VALUE_STORE_SEATS:
+            return 0
+        max_possible_score = state.grid_size * state.grid_size + 20
+        values = [state.calculate_score(p) / max_possible_score for p in state.players]
+        values += [0.0] * (VALUE_STORE_SEATS - len(values))
+        data = self._open(create=True)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            for key in positions:
+                self._update(data, key, values)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return len(positions)
+
+def canonical_key(state):
+    """开局库的键：8种对称变换下局面哈希（同store_key区分棋盘大小和玩家数）的最小值，返回 (键, 变换序号)
+
+    资源、回合和事件的哈希与变换无关，只有非空格子需要按各个变换重新计算。
+    """
+    board = state.board
+    occupied = [(idx, code) for idx, code in enumerate(board) if code != EMPTY]
+    rest = store_key(state)
+    for idx, code in occupied:
+        rest ^= cell_key(idx, code)
+    best = None
+    for t, table in enumerate(symmetries(state.grid_size)):
+        h = rest
+        for idx, code in occupied:
+            h ^= cell_key(table[idx], code)
+        if best is None or h < best[0]:
+            best = (h, t)
+    return best
+
+def transform_move(move, grid_size, t, inverse=False):
+    """把行动按对称变换t映射（inverse为True时按其逆变换），收集行动不变"""
+    action, position = move
+    if action != "occupy":
+        return move
+    x, y = position
+    table = symmetries(grid_size)[t]
+    if inverse:
+        return occupy_moves(grid_size)[table.index(y * grid_size + x)]
+    return occupy_moves(grid_size)[table[y * grid_size + x]]
+
+# 开局库文件
+# 文件头: 魔数 b"TOB1", 覆盖的回合数上限(u16), 布局数(u32), 条目数(u32)
+# 之后为布局: 棋盘大小(u16), 玩家数(u8), 填充5字节, 布局种子(u64，最高3位为0)；
+# 最后是按键升序排列的条目键(u64数组)和对应的行动编码(u16数组，规范变换下的encode_move)，均为小端序
+OPENING_BOOK_MAGIC = b"TOB1"
+_BOOK_HEADER = struct.Struct("<4sHII")
+_BOOK_LAYOUT = struct.Struct("<HB5xQ")
+
+class OpeningBook:
+    """离线生成的开局库：规范化局面（折叠8种对称变换）到最佳行动的映射，以及生成时使用的河流布局
+
+    新对局从库中的布局随机选取一个，并随机选一种对称变换，开局阶段的局面就能在库中查到。
+    第一次使用时才读取文件；文件不存在时库为空。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.max_turn = 0  # 只为回合数小于该值的局面保存了行动
+        self.layouts: Dict[Tuple[int, int], List[int]] = {}  # (棋盘大小, 玩家数) -> 布局种子
+        self.keys = array("Q")
+        self.moves = array("H")
+        self._loaded = False
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        magic, max_turn, layout_count, entry_count = _BOOK_HEADER.unpack_from(data, 0)
+        if magic != OPENING_BOOK_MAGIC:
+            raise ValueError(f"{self.path}不是有效的开局库文件")
+        offset = _BOOK_HEADER.size
+        for _ in range(layout_count):
+            grid_size, players, seed = _BOOK_LAYOUT.unpack_from(data, offset)
+            self.layouts.setdefault((grid_size, players), []).append(seed)
+            offset += _BOOK_LAYOUT.size
+        self.keys.frombytes(data[offset:offset + entry_count * 8])
+        offset += entry_count * 8
+        self.moves.frombytes(data[offset:offset + entry_count * 2])
+        if sys.byteorder == "big":
+            self.keys.byteswap()
+            self.moves.byteswap()
+        self.max_turn = max_turn
+
+    def __len__(self):
+        self._load()
+        return len(self.keys)
+
+    def random_seed(self, grid_size, n_players):
+        """从库中该规格的布局中随机选取，并随机选择对称变换；没有时返回None"""
+        self._load()
+        seeds = self.layouts.get((grid_size, n_players))
+        if not seeds:
+            return None
+        return random.choice(seeds) | (random.randrange(8) << SYMMETRY_SHIFT)
+
+    def lookup(self, state):
+        """返回库中该局面的行动（已映射回实际局面），没有时返回None"""
+        self._load()
+        if state.turn >= self.max_turn or not self.keys:
+            return None
+        key, t = canonical_key(state)
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        move = decode_move(self.moves[i], state.grid_size)
+        return transform_move(move, state.grid_size, t, inverse=True)
+
+    @staticmethod
+    def save(path, entries, layouts, max_turn):
+        """写入开局库：entries为 {规范键: 规范变换下行动的encode_move编码}，layouts为 [(棋盘大小, 玩家数, 布局种子)]"""
+        keys = sorted(entries)
+        with open(path, "wb") as f:
+            f.write(_BOOK_HEADER.pack(OPENING_BOOK_MAGIC, max_turn, len(layouts), len(keys)))
+            for grid_size, players, seed in layouts:
+                f.write(_BOOK_LAYOUT.pack(grid_size, players, seed))
+            keys = array("Q", keys)
+            moves = array("H", (entries[key] for key in keys))
+            if sys.byteorder == "big":
+                keys.byteswap()
+                moves.byteswap()
+            f.write(keys.tobytes())
+            f.write(moves.tobytes())
+
+def move_priors(state, player, moves, config=DEFAULT_AI_CONFIG):
+    """行动的先验权重，用于展开顺序和PUCT
+    
+    收集行动沿用模拟策略的权重；占领在资源足够（计入建筑折扣）时按rollout_occupy计，
+    靠近自己领地的格子略高、紧邻河流的略低，资源不足的占领几乎不会被选中。
+    """
+    resources = state.resources[player]
+    modifiers = state.event_modifiers()
+    affordable = resources["wood"] >= modifiers.build_wood and resources["gold"] >= modifiers.build_gold
+    board = state.board
+    size = state.grid_size
+    own = state.player_codes[player]
+    weights = []
+    for action, position in moves:
+        if action == "collect_wood":
+            weights.append(config.rollout_wood if resources["wood"] < 6 else config.rollout_other)
+        elif action == "collect_gold":
+            weights.append(config.rollout_gold if resources["gold"] < 4 else config.rollout_other)
+        elif not affordable:
+            weights.append(0.01)
+        else:
+            x, y = position
+            adjacent = river = 0
+            for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+                if 0 <= nx < size and 0 <= ny < size:
+                    code = board[ny * size + nx]
+                    adjacent += code == own
+                    river += code == RIVER
+            weights.append(config.rollout_occupy * (1 + 0.5 * adjacent) / (1 + 0.25 * river))
+    return weights
+
+# MCTS节点：player为该局面下轮到行动的玩家，wins按走到该节点的玩家(mover)的得分累计
 class MCTSNode:
-    def __init__(self, state, player, parent=None, move=None):
+    def __init__(self, state, player, parent=None, move=None, table=None, config=None, prior=1.0, store=None):
         self.state = state
         self.player = player
         self.parent = parent
         self.move = move
+        self.mover = parent.player if parent else None
         self.children = []
-        self.wins = 0
-        self.visits = 0
-        self.untried_moves = state.available_moves(player)
+        self.config = config or (parent.config if parent else DEFAULT_AI_CONFIG)
+        self.widening = self.config.progressive_widening  # 是否渐进展开（后台思考的根节点展开全部行动）
+        # 有置换表时，经不同行动顺序到达的相同局面共享访问数和得分
+        self.table = table
+        self.stats = table.node_stats(state.zobrist) if table is not None else NodeStats()
+        self.prior = prior  # 父节点展开本节点时的先验权重
+        self.child_priors = 0.0  # 已展开子节点的先验权重之和，用于归一化
+        # 价值库中的记录：样本数和各玩家的平均终局得分，选择时折算为虚拟访问
+        self.store = store if store is not None else (parent.store if parent else None)
+        self.stored = None
+        self.stored_visits = 0
+        self.stored_wins = 0.0
+        if self.store is not None and len(state.players) <= VALUE_STORE_SEATS:
+            entry = self.store.get(store_key(state))
+            if entry is not None:
+                count, values = entry
+                self.stored = (count, {p: values[i] for i, p in enumerate(state.players)})
+                if self.mover is not None:
+                    self.stored_visits = min(count, self.config.value_prior_visits)
+                    self.stored_wins = self.stored_visits * self.stored[1][self.mover]
+        self.set_untried_moves([] if state.is_game_over() else state.available_moves(player))
 
-    def select_child(self):
-        exploration = 1.4  # 增加探索性
-        return max(self.children, key=lambda c: c.wins / c.visits + exploration * math.sqrt(math.log(self.visits) / c.visits) if c.visits > 0 else float('inf'))
-
-    def expand(self):
-        move = self.untried_moves.pop(0)
-        new_state = self.state.copy()
-        new_state.apply_move(self.player, move)
-        child = MCTSNode(new_state, self.player, self, move)
-        self.children.append(child)
-        return child
-
-    def simulate(self):
-        state = self.state.copy()
-        current_player = self.player
-        
-        current_round = (state.turn // len(state.players)) + 1
-        while current_round <= 20 and not state.is_game_over():
-            moves = state.available_moves(current_player)
-            
-            # 平衡策略：根据当前资源状态选择行动
-            if moves:
-                weights = []
-                for move in moves:
-                    action, _ = move
-                    resources = state.resources[current_player]
-                    
-                    if action == "collect_wood" and resources["wood"] < 6:
-                        weights.append(2.0)  # 木材少时增加收集概率
-                    elif action == "collect_gold" and resources["gold"] < 4:
-                        weights.append(2.0)  # 金币少时增加收集概率
-                    elif action == "occupy" and resources["wood"] >= 2 and resources["gold"] >= 1:
-                        weights.append(3.0)  # 有足够资源时倾向于占领
-                    else:
-                        weights.append(1.0)
-                
-                move = random.choices(moves, weights=weights)[0]
-                state.apply_move(current_player, move)
-            
-            current_player = state.players[(state.players.index(current_player) + 1) % len(state.players)]
+    def set_untried_moves(self, moves):
+        # 按先验权重升序排列，展开时从末尾取出权重最高的行动
+        weights = move_priors(self.state, self.player, moves, self.config)
+        order = sorted(range(len(moves)), key=weights.__getitem__)
+        self.untried_moves = [moves[i] for i in order]
+        self.untried_priors = [weights[i] for i in order]
+
+    def reroot(self, state):
+        """把本节点作为新的根，用真实局面state替换模拟局面
         
-        # 根据综合得分评估结果
-        final_score = state.calculate_score(self.player)
-        max_possible_score = state.grid_size * state.grid_size + 20  # 最大可能分数
-        return final_score / max_possible_score  # 归一化的得分
+        子树是在模拟的事件和资源下建立的：剪掉在真实局面中无法执行的子节点，
+        未尝试的行动按真实局面重新计算（模拟中失败而被丢弃的行动可能重新可以执行）。
+        """
+        self.parent = None
+        self.mover = None
+        self.move = None
+        self.state = state
+        moves = [] if state.is_game_over() else state.executable_moves(self.player)
+        executable = set(moves)
+        self.children = [c for c in self.children if c.move in executable]
+        self.child_priors = sum(c.prior for c in self.children)
+        expanded = {c.move for c in self.children}
+        self.set_untried_moves([m for m in moves if m not in expanded])
+
+    @property
+    def visits(self):
+        return self.stats.visits
+
+    @property
+    def wins(self):
+        return self.stats.wins
+
+    def can_expand(self):
+        """渐进展开：已展开的子节点数随访问次数增长，未达到上限且还有未尝试的行动时继续展开"""
+        if not self.untried_moves:
+            return False
+        if not self.widening:
+            return True
+        config = self.config
+        return len(self.children) < config.widening_base * max(self.visits, 1) ** config.widening_exponent
+
+    def select_child(self):
+        # 价值库中的记录作为虚拟访问计入子节点的Q和访问数
+        if self.widening:
+            # PUCT：Q + c * P * sqrt(N) / (1 + n)，P为子节点先验在已展开子节点中的占比
+            scale = self.config.c_puct * math.sqrt(self.visits) / self.child_priors
+            def puct(c):
+                n = c.visits + c.stored_visits
+                return (c.wins + c.stored_wins) / n + scale * c.prior / (1 + n) if n > 0 else scale * c.prior
+            return max(self.children, key=puct)
+        exploration = self.config.exploration
+        log_visits = math.log(self.visits)
+        def uct(c):
+            n = c.visits + c.stored_visits
+            return (c.wins + c.stored_wins) / n + exploration * math.sqrt(log_visits / n) if n > 0 else float('inf')
+        return max(self.children, key=uct)
+
+    def expand(self, stats=None):
+        # 资源不足等无法执行的行动直接丢弃；全部无法执行时返回自身
+        while self.untried_moves:
+            move = self.untried_moves.pop()
+            prior = self.untried_priors.pop()
+            new_state = self.state.copy()
+            if stats is not None:
+                stats.state_copies += 1
+            if new_state.apply_move(self.player, move):
+                next_player = new_state.players[new_state.turn % len(new_state.players)]
+                child = MCTSNode(new_state, next_player, self, move, self.table, self.config, prior, self.store)
+                self.children.append(child)
+                self.child_priors += prior
+                if stats is not None:
+                    stats.nodes_created += 1
+                return child
+        return self
+
+    def find_child(self, player, move):
+        for child in self.children:
+            if child.mover == player and child.move == move:
+                return child
+        return None
+
+    def stored_estimate(self, stats=None):
+        """价值库中样本数达到value_cutoff_visits时返回记录的各玩家得分，用于代替模拟"""
+        cutoff = self.config.value_cutoff_visits
+        if self.stored is None or cutoff is None or self.stored[0] < cutoff:
+            return None
+        if stats is not None:
+            stats.value_cutoffs += 1
+        return self.stored[1]
+
+    def simulate(self, stats=None):
+        """随机模拟到游戏结束，返回每个玩家的归一化得分"""
+        estimate = self.stored_estimate(stats)
+        if estimate is not None:
+            return estimate
+        if stats is not None:
+            stats.state_copies += 1
+        return rollout(self.state.copy(), self.config, stats)
+
+    def simulate_batch(self, k, stats=None):
+        """用NumPy批量模拟k局，返回每个玩家的平均归一化得分"""
+        estimate = self.stored_estimate(stats)
+        if estimate is not None:
+            return estimate
+        return batched_rollout(self.state, k, stats, self.config)
 
     def backpropagate(self, result):
-        self.visits += 1
-        self.wins += result
-        if self.parent:
-            self.parent.backpropagate(result)
+        node = self
+        while node is not None:
+            node.stats.visits += 1
+            if node.mover is not None:
+                node.stats.wins += result[node.mover]
+            node = node.parent
+
+def evaluate(state):
+    """静态估分：估计每个玩家的最终得分，按与模拟相同的 得分 / (grid_size² + 20) 归一化
+    
+    手上的资源按当前建筑费用折算成可立即占领的格子；剩余回合按占领效率估计还能占领的格子，
+    生效事件（倍率、折扣）在其结束前提高效率；所有玩家的预计占领数之和不超过剩余空地。
+    """
+    max_possible_score = state.grid_size * state.grid_size + 20  # 最大可能分数
+    if state.is_game_over():
+        return {p: state.calculate_score(p) / max_possible_score for p in state.players}
+    
+    n = len(state.players)
+    current_round = state.turn // n + 1
+    modifiers = state.event_modifiers(current_round)
+    event_rounds = modifiers.expires - current_round if modifiers.expires is not None else 0
+    
+    def occupy_rate(m):
+        # 平均每回合的占领数：一次占领加上凑齐费用所需的收集次数
+        return 1 / (1 + m.build_wood / (3 * m.wood_multiplier) + m.build_gold / (2 * m.gold_multiplier))
+    
+    event_rate = occupy_rate(modifiers)
+    base_rate = occupy_rate(NO_MODIFIERS)
+    cost_wood, cost_gold = modifiers.build_wood, modifiers.build_gold
+    position = state.turn % n
+    potential = []
+    leftover = []
+    for i, p in enumerate(state.players):
+        # 本大回合还没行动的玩家多一回合
+        turns = 20 - current_round + (1 if i >= position else 0)
+        resources = state.resources[p]
+        immediate = min(resources["wood"] // cost_wood if cost_wood else turns,
+                        resources["gold"] // cost_gold if cost_gold else turns, turns)
+        rest = turns - immediate
+        boosted = min(rest, max(event_rounds - 1, 0))
+        potential.append(immediate + boosted * event_rate + (rest - boosted) * base_rate)
+        leftover.append(resources["wood"] + resources["gold"] - immediate * (cost_wood + cost_gold))
+    total = sum(potential)
+    free = len(state.empty_cells)
+    scale = free / total if total > free else 1.0
+    return {p: ((state.territory[p] + potential[i] * scale) * 2 + leftover[i] * 0.1) / max_possible_score
+            for i, p in enumerate(state.players)}
+
+def rollout(state, config=DEFAULT_AI_CONFIG, stats=None):
+    """在state上按平衡策略随机走到游戏结束（直接修改state），返回每个玩家的归一化得分
+    
+    config.rollout_depth不为None时，走到该步数就停止并用evaluate估分。
+    """
+    start_turn = state.turn
+    end_turn = start_turn + config.rollout_depth if config.rollout_depth is not None else None
+    
+    while not state.is_game_over():
+        if end_turn is not None and state.turn >= end_turn:
+            if stats is not None:
+                stats.rollouts += 1
+                stats.rollout_plies += state.turn - start_turn
+            return evaluate(state)
+        current_player = state.players[state.turn % len(state.players)]
+        # 先结算大回合开始时的事件，再按结算后的费用判断能否占领
+        modifiers = state.event_modifiers(state.start_turn())
+        resources = state.resources[current_player]
+        wood, gold = resources["wood"], resources["gold"]
+        
+        # 平衡策略：根据当前资源状态选择行动，所有占领行动共享一个权重。
+        # 资源不足的占领执行会失败，不参与抽样，因此抽中的行动总能执行
+        weight_wood = config.rollout_wood if wood < 6 else config.rollout_other  # 木材少时增加收集概率
+        weight_gold = config.rollout_gold if gold < 4 else config.rollout_other  # 金币少时增加收集概率
+        if wood < modifiers.build_wood or gold < modifiers.build_gold:
+            weight_occupy = 0.0
+        elif wood >= 2 and gold >= 1:
+            weight_occupy = config.rollout_occupy  # 有足够资源时倾向于占领
+        else:
+            weight_occupy = config.rollout_other
+        
+        pick = random.random() * (weight_wood + weight_gold + len(state.empty_cells) * weight_occupy)
+        if pick < weight_wood:
+            move = ("collect_wood", None)
+        elif pick < weight_wood + weight_gold:
+            move = ("collect_gold", None)
+        else:
+            move = occupy_moves(state.grid_size)[random.choice(tuple(state.empty_cells))]
+        state.apply_move(current_player, move)
+    
+    if stats is not None:
+        stats.rollouts += 1
+        stats.rollout_plies += state.turn - start_turn
+    
+    # 根据综合得分评估结果
+    max_possible_score = state.grid_size * state.grid_size + 20  # 最大可能分数
+    return {p: state.calculate_score(p) / max_possible_score for p in state.players}  # 归一化的得分
+
+# 批量模拟用的事件参数表，按事件权重缓存，首次使用时由EVENT_CATALOG生成
+_ROLLOUT_EVENT_TABLES: Dict[EventWeights, dict] = {}
+
+def _rollout_event_table(event_weights=DEFAULT_EVENT_WEIGHTS):
+    table = _ROLLOUT_EVENT_TABLES.get(event_weights)
+    if table is None:
+        # 与check_and_trigger_events相同的编译事件表，各事件的效果按MODIFIER_RULES汇总
+        compiled = compiled_events(event_weights)
+        effects = [EventModifiers((e,)) for e in compiled.events]
+        table = _ROLLOUT_EVENT_TABLES[event_weights] = {
+            "names": [e.name for e in compiled.events],
+            "weight_mid": np.array([w for _, w in compiled.mid]),
+            "weight_early": np.array([w for _, w in compiled.early]),
+            "weight_late": np.array([w for _, w in compiled.late]),
+            "wood_multiplier": np.array([m.wood_multiplier for m in effects]),
+            "gold_multiplier": np.array([m.gold_multiplier for m in effects]),
+            "build_discount": np.array([m.build_discount for m in effects]),
+        }
+    return table
+
+def batched_rollout(state, k, stats=None, config=None):
+    """在NumPy数组上同时模拟k局，复现simulate的策略和事件效果，返回每个玩家的平均归一化得分
+    
+    规则中格子位置不影响结果，所以每局棋盘只记录空地数和各玩家领地数。
+    """
+    config = config or DEFAULT_AI_CONFIG
+    extra_trigger = state.event_weights.extra_trigger
+    table = _rollout_event_table(state.event_weights)
+    rng = np.random.default_rng(random.getrandbits(64))
+    players = state.players
+    n = len(players)
+    rows = np.arange(k)
+    
+    turn = np.full(k, state.turn)
+    free = np.full(k, len(state.empty_cells))
+    territory = np.tile(np.array([state.territory[p] for p in players]), (k, 1))
+    wood = np.tile(np.array([state.resources[p]["wood"] for p in players]), (k, 1))
+    gold = np.tile(np.array([state.resources[p]["gold"] for p in players]), (k, 1))
+    # 各事件的结束回合，0表示未激活
+    expiry = np.zeros((k, len(table["names"])), dtype=np.int64)
+    for name, event in state.active_events.items():
+        expiry[:, table["names"].index(name)] = event.duration
+    
+    def trigger_events(candidates, current_round):
+        """为candidates中的对局各触发一个未激活的事件，权重同check_and_trigger_events"""
+        active = expiry > 0
+        weights = np.where(current_round[:, None] <= 5, table["weight_early"],
+                           np.where(current_round[:, None] >= 15, table["weight_late"], table["weight_mid"]))
+        cumulative = (weights * ~active).cumsum(axis=1)
+        total = cumulative[:, -1]
+        candidates = candidates & (total > 0)
+        picked = (cumulative <= (rng.random(k) * total)[:, None]).sum(axis=1)
+        expiry[rows[candidates], picked[candidates]] = (current_round[candidates] +
+                                                        rng.integers(2, 4, size=candidates.sum()))
+    
+    def event_modifiers(current_round):
+        """汇总生效事件的修正：木材倍率、金币倍率、占领所需木材和金币"""
+        effective = expiry > current_round[:, None]
+        discount = (effective * table["build_discount"]).sum(axis=1)
+        return (np.where(effective, table["wood_multiplier"], 1).prod(axis=1),
+                np.where(effective, table["gold_multiplier"], 1).prod(axis=1),
+                np.maximum(2 - discount, 0),
+                np.maximum(1 - discount, 0))
+    
+    while True:
+        current_round = turn // n + 1
+        live = (current_round <= 20) & (free > 0)
+        if not live.any():
+            break
+        player = turn % n
+        
+        # 大回合开始：移除过期事件，再按check_and_trigger_events的规则触发新事件
+        round_start = live & (player == 0)
+        if round_start.any():
+            expiry[round_start[:, None] & (expiry > 0) & (expiry <= current_round[:, None])] = 0
+            count = (expiry > 0).sum(axis=1)
+            trigger_events(round_start & ((count == 0) | ((count < 2) & (rng.random(k) < extra_trigger))), current_round)
+        
+        my_wood = wood[rows, player]
+        my_gold = gold[rows, player]
+        weight_wood = np.where(my_wood < 6, config.rollout_wood, config.rollout_other)
+        weight_gold = np.where(my_gold < 4, config.rollout_gold, config.rollout_other)
+        weight_occupy = np.where((my_wood >= 2) & (my_gold >= 1), config.rollout_occupy, config.rollout_other)
+        
+        wood_multiplier, gold_multiplier, cost_wood, cost_gold = event_modifiers(current_round)
+        affordable = (my_wood >= cost_wood) & (my_gold >= cost_gold)
+        
+        # 平衡策略：与simulate相同的权重，所有占领行动共享一个权重，资源不足的占领不参与抽样
+        weight_occupy = weight_occupy * affordable
+        pick = rng.random(k) * (weight_wood + weight_gold + free * weight_occupy)
+        collect_wood = live & (pick < weight_wood)
+        collect_gold = live & ~collect_wood & (pick < weight_wood + weight_gold)
+        occupy = live & ~collect_wood & ~collect_gold
+        
+        wood[rows, player] += np.where(collect_wood, 3 * wood_multiplier, 0) - np.where(occupy, cost_wood, 0)
+        gold[rows, player] += np.where(collect_gold, 2 * gold_multiplier, 0) - np.where(occupy, cost_gold, 0)
+        territory[rows, player] += occupy
+        free -= occupy
+        turn += live
+    
+    if stats is not None:
+        stats.rollouts += k
+        stats.rollout_plies += int((turn - state.turn).sum())
+    
+    max_possible_score = state.grid_size * state.grid_size + 20  # 最大可能分数
+    scores = (territory * 2 + (wood + gold) * 0.1).mean(axis=0) / max_possible_score
+    return {p: float(scores[i]) for i, p in enumerate(players)}
+
+# 搜索中让出控制权（如socketio.sleep(0)）的最小间隔，单位秒
+YIELD_INTERVAL = 0.02
+
+# 后台思考的根节点展开对手的全部行动且不用先验，访问数在各行动间大致平均分配，对手实际行动对应的子树
+# 只有约 迭代数 / 行动数 次访问（9x9开局75个行动）。复用的子树达到这一平均值的PONDER_MIN_SHARE，
+# 且不少于PONDER_MIN_VISITS时，GameAI.ponder_think_ms生效
+PONDER_MIN_SHARE = 0.5
+PONDER_MIN_VISITS = 16
+
+def mcts_search(state, player, iterations=None, deadline=None, yield_fn=None, root=None, rollout_batch=1,
+                table=None, stats=None, config=None, stop_fn=None, store=None):
+    """从state出发为player执行MCTS，返回根节点
+    
+    迭代次数用完或到达deadline（time.perf_counter()时刻）时停止，至少迭代一次；
+    yield_fn不为空时每隔YIELD_INTERVAL调用一次，让其他协程继续运行。
+    传入root时在已有的搜索树上继续搜索；rollout_batch大于1时每次迭代用NumPy批量模拟；
+    传入table时节点通过置换表共享相同局面的统计；传入stats时记录各阶段耗时和树的规模；
+    config为新建根节点的AI参数，复用的root沿用自己的参数；stop_fn返回True时在本次迭代后停止；
+    store为新建根节点的价值库（ValueStore），其中的记录用作子节点的先验和模拟的截断估值。
+    """
+    if stats is None:
+        stats = SearchStats()
+    if root is None:
+        # 根节点保存快照，实际局面之后的变化不会影响复用时的比对
+        snapshot = state.copy()
+        if config is not None and config.event_weights is not None:
+            snapshot.event_weights = config.event_weights
+        root = MCTSNode(snapshot, player, table=table, config=config, store=store)
+        stats.state_copies += 1
+    clock = time.perf_counter
+    
+    def step():
+        node = root
+        depth = 0
+        while node.children and not node.can_expand():
+            node = node.select_child()
+            depth += 1
+        selected = clock()
+        if node.untried_moves:
+            child = node.expand(stats)
+            if child is not node:
+                depth += 1
+            node = child
+        expanded = clock()
+        reward = node.simulate_batch(rollout_batch, stats) if rollout_batch > 1 else node.simulate(stats)
+        simulated = clock()
+        node.backpropagate(reward)
+        return depth, selected, expanded, simulated
+    
+    run_iterations(step, stats, iterations, deadline, yield_fn, stop_fn)
+    stats.tree_size = tree_size(root)
+    return root
+
+def run_iterations(step, stats, iterations=None, deadline=None, yield_fn=None, stop_fn=None):
+    """mcts_search和pool_search共用的迭代循环：各阶段计时、迭代次数、截止时间、让出控制权和停止条件
+    
+    step()执行一次迭代（含反向传播），返回 (深度, 选择结束时刻, 展开结束时刻, 模拟结束时刻)，
+    时刻取自time.perf_counter()。参数含义同mcts_search，至少迭代一次。
+    """
+    completed = 0
+    clock = time.perf_counter
+    last_yield = clock()
+    
+    while True:
+        started = clock()
+        depth, selected, expanded, simulated = step()
+        finished = clock()
+        
+        stats.selection_time += selected - started
+        stats.expansion_time += expanded - selected
+        stats.simulation_time += simulated - expanded
+        stats.backpropagation_time += finished - simulated
+        if depth > stats.max_depth:
+            stats.max_depth = depth
+        stats.iterations += 1
+        
+        completed += 1
+        if iterations is not None and completed >= iterations:
+            break
+        if stop_fn is not None and stop_fn():
+            break
+        if deadline is not None or yield_fn is not None:
+            now = clock()
+            if deadline is not None and now >= deadline:
+                break
+            if yield_fn is not None and now - last_yield >= YIELD_INTERVAL:
+                yield_fn()
+                last_yield = clock()
+
+def tree_size(root):
+    """子树中的节点数"""
+    count = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.children)
+    return count
+
+def root_statistics(root):
+    """根节点各子节点的 {move: (visits, wins)}"""
+    return {child.move: (child.visits, child.wins) for child in root.children}
+
+# 行动的整数编码：0收集木材，1收集金币，2 + 格子序号为占领
+def encode_move(move, grid_size):
+    action, position = move
+    if action == "collect_wood":
+        return 0
+    if action == "collect_gold":
+        return 1
+    x, y = position
+    return 2 + y * grid_size + x
+
+def decode_move(code, grid_size):
+    if code == 0:
+        return ("collect_wood", None)
+    if code == 1:
+        return ("collect_gold", None)
+    return occupy_moves(grid_size)[code - 2]
+
+class NodePool:
+    """数组存储的搜索树，容量固定，用于大迭代次数的搜索
+    
+    节点的访问数、得分、父节点等存放在预先分配的平行数组中，节点序号即数组下标，根节点为0。
+    节点展开时在边数组中占用一段连续区间，按先验从高到低存放先验最高的若干个行动，
+    前 expanded[n] 条边已展开；区间用完时重新分配一段两倍长的区间（旧区间不再使用）。
+    节点不保存局面，搜索时从根局面沿路径重放行动得到。
+    节点或边的容量用完后不再展开新节点，已有节点继续积累统计。
+    """
+
+    def __init__(self, state, player, config=None, max_nodes=200000, max_edges=2000000):
+        self.state = state.copy()  # 根局面快照
+        self.players = state.players
+        self.config = config or DEFAULT_AI_CONFIG
+        self.max_nodes = max_nodes
+        self.max_edges = max_edges
+        self.visits = array("i", [0]) * max_nodes
+        self.wins = array("d", [0.0]) * max_nodes
+        self.parent = array("i", [-1]) * max_nodes
+        self.player = array("b", [0]) * max_nodes  # 轮到行动的玩家序号
+        self.mover = array("b", [-1]) * max_nodes  # 走到该节点的玩家序号，根节点为-1
+        self.edge_start = array("i", [-1]) * max_nodes  # -1表示还没展开过
+        self.edge_count = array("i", [0]) * max_nodes  # 边区间中存放的行动数
+        self.move_count = array("i", [0]) * max_nodes  # 可执行的行动总数（含还没放进边区间的）
+        self.expanded = array("i", [0]) * max_nodes  # 已展开的子节点数
+        self.edge_move = array("i", [0]) * max_edges
+        self.edge_prior = array("f", [0.0]) * max_edges
+        self.edge_child = array("i", [-1]) * max_edges
+        self.size = 1
+        self.edges_used = 0
+        self.player[0] = self.players.index(player)
+        self._views = None
+        if np is not None:
+            # NumPy视图与数组共享内存（容量固定，数组不会重新分配），用于向量化选择
+            self._views = (np.frombuffer(self.visits, dtype=np.intc),
+                           np.frombuffer(self.wins, dtype=np.float64),
+                           np.frombuffer(self.edge_prior, dtype=np.float32),
+                           np.frombuffer(self.edge_child, dtype=np.intc))
+
+    def open(self, node, state, capacity):
+        """为node分配一段能放capacity个行动的边区间：先复制已展开的边，再按先验从高到低放入未尝试的行动
+        
+        边容量不足时返回False。
+        """
+        player = self.players[self.player[node]]
+        old_start = self.edge_start[node]
+        expanded = self.expanded[node]
+        tried = set(self.edge_move[old_start:old_start + expanded]) if old_start >= 0 else set()
+        grid_size = state.grid_size
+        moves = [m for m in state.available_moves(player) if encode_move(m, grid_size) not in tried]
+        count = min(expanded + len(moves), capacity)
+        start = self.edges_used
+        if start + count > self.max_edges:
+            return False
+        if expanded:
+            self.edge_move[start:start + expanded] = self.edge_move[old_start:old_start + expanded]
+            self.edge_prior[start:start + expanded] = self.edge_prior[old_start:old_start + expanded]
+            self.edge_child[start:start + expanded] = self.edge_child[old_start:old_start + expanded]
+        weights = move_priors(state, player, moves, self.config)
+        order = sorted(range(len(moves)), key=weights.__getitem__, reverse=True)[:count - expanded]
+        for offset, i in enumerate(order, start + expanded):
+            self.edge_move[offset] = encode_move(moves[i], grid_size)
+            self.edge_prior[offset] = weights[i]
+        self.edge_start[node] = start
+        self.edge_count[node] = count
+        self.move_count[node] = expanded + len(moves)
+        self.edges_used += count
+        return True
+
+    def can_expand(self, node):
+        expanded = self.expanded[node]
+        if self.edge_start[node] >= 0 and expanded >= self.move_count[node]:
+            return False
+        if self.size >= self.max_nodes:
+            return False
+        config = self.config
+        if not config.progressive_widening:
+            return True
+        return expanded < config.widening_base * max(self.visits[node], 1) ** config.widening_exponent
+
+    def expand(self, node, state, stats=None):
+        """在state（node的局面）上执行下一个未尝试的行动并创建子节点，返回子节点；无法展开时返回node
+        
+        在当前的事件抽样下无法执行的行动从边区间中移除。
+        """
+        player = self.players[self.player[node]]
+        while True:
+            expanded = self.expanded[node]
+            if self.edge_start[node] < 0 or expanded == self.edge_count[node]:
+                if self.edge_start[node] >= 0 and expanded >= self.move_count[node]:
+                    return node
+                # 不渐进展开时一次放入全部行动，否则按两倍增长
+                capacity = max(4, 2 * self.edge_count[node]) if self.config.progressive_widening else 1 << 30
+                if not self.open(node, state, capacity) or self.edge_count[node] == expanded:
+                    return node
+            start = self.edge_start[node]
+            slot = start + expanded
+            if state.apply_move(player, decode_move(self.edge_move[slot], state.grid_size)):
+                child = self.size
+                self.size += 1
+                self.parent[child] = node
+                self.mover[child] = self.player[node]
+                self.player[child] = state.turn % len(self.players)
+                self.edge_child[slot] = child
+                self.expanded[node] += 1
+                if stats is not None:
+                    stats.nodes_created += 1
+                return child
+            end = start + self.edge_count[node]
+            # 无法执行的行动从区间中移除；它是最后一条边时不用移动（edge_prior有NumPy视图时，
+            # 空切片赋值也会按改变长度处理，引发BufferError）
+            if slot + 1 < end:
+                self.edge_move[slot:end - 1] = self.edge_move[slot + 1:end]
+                self.edge_prior[slot:end - 1] = self.edge_prior[slot + 1:end]
+            self.edge_count[node] -= 1
+            self.move_count[node] -= 1
+
+    def select(self, node):
+        """按PUCT（渐进展开时）或UCT选择已展开的子节点，返回 (子节点, 行动编码)"""
+        start = self.edge_start[node]
+        count = self.expanded[node]
+        config = self.config
+        parent_visits = self.visits[node]
+        if self._views is not None and count > 8:
+            visits_view, wins_view, prior_view, child_view = self._views
+            children = child_view[start:start + count]
+            visits = visits_view[children].astype(np.float64)
+            wins = wins_view[children]
+            if config.progressive_widening:
+                priors = prior_view[start:start + count]
+                scale = config.c_puct * math.sqrt(parent_visits) / priors.sum()
+                scores = np.divide(wins, visits, out=np.zeros(count), where=visits > 0) + scale * priors / (1 + visits)
+            else:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    scores = np.where(visits > 0, wins / visits + config.exploration *
+                                      np.sqrt(math.log(max(parent_visits, 1)) / visits), np.inf)
+            best = int(scores.argmax())
+        else:
+            visits_arr, wins_arr, children = self.visits, self.wins, self.edge_child
+            best, best_score = 0, -math.inf
+            if config.progressive_widening:
+                total = sum(self.edge_prior[start:start + count])
+                scale = config.c_puct * math.sqrt(parent_visits) / total
+                for i in range(count):
+                    child = children[start + i]
+                    n = visits_arr[child]
+                    score = (wins_arr[child] / n if n > 0 else 0.0) + scale * self.edge_prior[start + i] / (1 + n)
+                    if score > best_score:
+                        best, best_score = i, score
+            else:
+                log_visits = math.log(max(parent_visits, 1))
+                for i in range(count):
+                    child = children[start + i]
+                    n = visits_arr[child]
+                    score = (wins_arr[child] / n + config.exploration * math.sqrt(log_visits / n)
+                             if n > 0 else math.inf)
+                    if score > best_score:
+                        best, best_score = i, score
+        return self.edge_child[start + best], self.edge_move[start + best]
+
+    def backpropagate(self, node, result):
+        scores = [result[p] for p in self.players]
+        visits, wins, mover, parent = self.visits, self.wins, self.mover, self.parent
+        while node >= 0:
+            visits[node] += 1
+            if mover[node] >= 0:
+                wins[node] += scores[mover[node]]
+            node = parent[node]
+
+    def root_statistics(self):
+        """根节点各子节点的 {move: (visits, wins)}"""
+        start = self.edge_start[0]
+        grid_size = self.state.grid_size
+        return {decode_move(self.edge_move[start + i], grid_size):
+                (self.visits[self.edge_child[start + i]], self.wins[self.edge_child[start + i]])
+                for i in range(self.expanded[0])} if start >= 0 else {}
+
+    def memory_bytes(self):
+        node_arrays = (self.visits, self.wins, self.parent, self.player, self.mover,
+                       self.edge_start, self.edge_count, self.move_count, self.expanded)
+        edge_arrays = (self.edge_move, self.edge_prior, self.edge_child)
+        return sum(a.itemsize * len(a) for a in node_arrays + edge_arrays)
+
+# NodePool每个节点预留的边数：只有被再次访问的节点才会展开并占用边区间
+POOL_EDGES_PER_NODE = 8
+
+def pool_search(state, player, iterations=None, deadline=None, yield_fn=None, rollout_batch=1, stats=None,
+                config=None, max_nodes=200000, max_edges=2000000):
+    """与mcts_search相同的搜索，树存放在NodePool中，返回NodePool
+    
+    每次迭代复制一次根局面并沿选择路径重放行动；事件在每次重放中重新抽样（开环搜索），
+    路径上的行动在本次抽样下无法执行时，从该节点直接模拟。
+    """
+    if stats is None:
+        stats = SearchStats()
+    tree = NodePool(state, player, config, max_nodes, max_edges)
+    config = tree.config
+    clock = time.perf_counter
+    
+    def step():
+        node = 0
+        depth = 0
+        current = tree.state.copy()
+        stats.state_copies += 1
+        while not current.is_game_over() and tree.expanded[node] > 0 and not tree.can_expand(node):
+            child, move = tree.select(node)
+            if not current.apply_move(tree.players[tree.player[node]], decode_move(move, current.grid_size)):
+                break
+            node = child
+            depth += 1
+        selected = clock()
+        if not current.is_game_over() and tree.can_expand(node):
+            child = tree.expand(node, current, stats)
+            if child != node:
+                node = child
+                depth += 1
+        expanded = clock()
+        if rollout_batch > 1:
+            reward = batched_rollout(current, rollout_batch, stats, config)
+        else:
+            reward = rollout(current, config, stats)
+        simulated = clock()
+        tree.backpropagate(node, reward)
+        return depth, selected, expanded, simulated
+    
+    run_iterations(step, stats, iterations, deadline, yield_fn)
+    stats.tree_size = tree.size
+    return tree
+
+def _search_worker(state, player, iterations, budget, seed, rollout_batch, table_size, config=None, pool_nodes=0,
+                   store=None):
+    """进程池中的一棵独立搜索树，budget为秒数（None表示不限时），table_size为0时不用置换表"""
+    random.seed(seed)
+    deadline = time.perf_counter() + budget if budget is not None else None
+    table = TranspositionTable(table_size) if table_size else None
+    stats = SearchStats()
+    if pool_nodes:
+        tree = pool_search(state, player, iterations, deadline, rollout_batch=rollout_batch, stats=stats,
+                           config=config, max_nodes=pool_nodes, max_edges=pool_nodes * POOL_EDGES_PER_NODE)
+        return tree.root_statistics(), stats
+    root = mcts_search(state, player, iterations, deadline, rollout_batch=rollout_batch, table=table, stats=stats,
+                       config=config, store=store)
+    return root_statistics(root), stats
+
+# 按工作进程数缓存的进程池，首次并行搜索时创建
+_SEARCH_POOLS: Dict[int, ProcessPoolExecutor] = {}
+
+def get_search_pool(workers):
+    pool = _SEARCH_POOLS.get(workers)
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        _SEARCH_POOLS[workers] = pool
+    return pool
 
 # AI类
 class GameAI:
-    def __init__(self, name):
+    def __init__(self, name, iterations=150, workers=1, think_ms=None, rollout_batch=1, table_size=100000,
+                 config: Optional[AIConfig] = None, pool_nodes=0, value_store: Optional[ValueStore] = None,
+                 opening_book: Optional[OpeningBook] = None):
+        if iterations is None and think_ms is None:
+            raise ValueError("iterations和think_ms至少需要设置一个")
+        if rollout_batch > 1 and np is None:
+            raise ImportError("rollout_batch大于1需要安装NumPy")
         self.name = name
-        self.q_table = defaultdict(lambda: 0)
-        self.learning_rate = 0.2  # 提高学习率
-        self.discount = 0.8  # 降低折扣因子，更注重短期收益
-        self.epsilon = 0.2  # 探索率
-
-    def get_action(self, state, iterations=150):  # 增加迭代次数
-        root = MCTSNode(state, self.name)
-        
-        for _ in range(iterations):
-            node = root
-            while node.untried_moves == [] and node.children != []:
-                node = node.select_child()
-            if node.untried_moves:
-                node = node.expand()
-            reward = node.simulate()
-            node.backpropagate(reward)
+        self.config = config or DEFAULT_AI_CONFIG
+        self.epsilon = self.config.epsilon  # 探索率
+        self.iterations = iterations  # 每棵搜索树的迭代次数上限，None表示只按时间
+        self.workers = workers  # 大于1时在进程池中并行搜索多棵树（根并行）
+        self.think_ms = think_ms  # 每步思考时间（毫秒），None表示只按迭代次数
+        self.rollout_batch = rollout_batch  # 每次迭代的模拟局数，大于1时使用NumPy批量模拟
+        self.tree: Optional[MCTSNode] = None  # 上一次搜索的根节点，供下一步复用
+        self.table_size = table_size  # 置换表的容量，0表示不使用
+        self.table = TranspositionTable(table_size) if table_size else None
+        self.last_stats = SearchStats()  # 最近一次决策的搜索统计
+        self.pool_nodes = pool_nodes  # 大于0时用容量为pool_nodes的NodePool搜索（不复用搜索树，不用置换表和价值库）
+        self.value_store = value_store  # 持久化的局面价值库，用作先验和模拟截断，可由多个AI共享
+        self.opening_book = opening_book  # 开局库，查到的局面不再搜索
+        self.pondering = False  # 是否正在后台思考
+        self.ponder_stats = SearchStats()  # 最近一次后台思考的搜索统计
+        self.ponder_think_ms: Optional[int] = None  # 复用的子树已有足够访问时的思考时间上限
+        self.ponder_share: Optional[float] = None  # 最近一次后台思考中对手每个行动平均得到的访问数
+
+    def reuse_tree(self, state, player=None):
+        """沿实际走过的行动从上次的搜索树下降，返回对应子树的根；无法匹配时返回None
+        
+        子树根必须轮到player行动（默认为自己；后台思考时为对手）。
+        """
+        node = self.tree
+        self.tree = None
+        if node is None:
+            return None
+        known = len(node.state.moves)
+        if len(state.moves) < known or state.moves[:known] != node.state.moves:
+            return None
+        for mover, move in state.moves[known:]:
+            node = node.find_child(mover, move)
+            if node is None:
+                return None
+        if node.player != (player or self.name):
+            return None
+        
+        # 剪掉树的其余部分；事件是随机的，用真实局面替换子树根的模拟局面
+        snapshot = state.copy()
+        if self.config.event_weights is not None:
+            snapshot.event_weights = self.config.event_weights
+        node.reroot(snapshot)
+        return node
+
+    def search(self, state, iterations, think_ms=None, yield_fn=None):
+        """返回合并后的根节点统计 {move: (visits, wins)}"""
+        budget = think_ms / 1000 if think_ms is not None else None
+        self.last_stats = SearchStats()
+        ponder_share, self.ponder_share = self.ponder_share, None
+        if self.workers <= 1 and self.pool_nodes:
+            deadline = time.perf_counter() + budget if budget is not None else None
+            tree = pool_search(state, self.name, iterations, deadline, yield_fn, self.rollout_batch, self.last_stats,
+                               self.config, self.pool_nodes, self.pool_nodes * POOL_EDGES_PER_NODE)
+            return tree.root_statistics()
+        if self.workers <= 1:
+            root = self.reuse_tree(state)
+            if (root is not None and budget is not None and self.ponder_think_ms is not None and
+                    ponder_share is not None and
+                    root.visits >= max(PONDER_MIN_VISITS, PONDER_MIN_SHARE * ponder_share)):
+                # 后台思考已经为这一步积累了足够的访问，缩短思考时间
+                budget = min(budget, self.ponder_think_ms / 1000)
+            deadline = time.perf_counter() + budget if budget is not None else None
+            root = mcts_search(state, self.name, iterations, deadline, yield_fn, root,
+                               self.rollout_batch, self.table, self.last_stats, self.config, store=self.value_store)
+            self.tree = root
+            return root_statistics(root)
+        
+        # 根并行：每个进程从同一局面独立建树，再按行动合并访问数和胜分
+        pool = get_search_pool(self.workers)
+        snapshot = state.copy()
+        futures = [pool.submit(_search_worker, snapshot, self.name, iterations, budget, random.getrandbits(32),
+                               self.rollout_batch, self.table_size, self.config, self.pool_nodes, self.value_store)
+                   for _ in range(self.workers)]
+        while wait(futures, timeout=YIELD_INTERVAL).not_done:
+            if yield_fn is not None:
+                yield_fn()
+        merged: Dict[Any, Tuple[int, float]] = {}
+        for future in futures:
+            statistics, worker_stats = future.result()
+            self.last_stats.merge(worker_stats)
+            for move, (visits, wins) in statistics.items():
+                total_visits, total_wins = merged.get(move, (0, 0))
+                merged[move] = (total_visits + visits, total_wins + wins)
+        return merged
+
+    def can_ponder(self):
+        """后台思考的结果靠复用搜索树传给下一步，只有单进程的对象树支持"""
+        return self.workers <= 1 and not self.pool_nodes
+
+    def ponder(self, state, player, stop_fn, yield_fn=None, max_iterations=None):
+        """对手player思考时在后台继续搜索，直到stop_fn()为真或达到max_iterations
+        
+        从state（轮到player）开始，能复用上一步的搜索树时沿实际行动下降后继续搜索；
+        根节点展开对手的全部行动。
+        对手行动后，get_action通过reuse_tree保留与实际行动对应的子树，其余部分丢弃。
+        """
+        if not self.can_ponder():
+            return
+        self.pondering = True
+        try:
+            self.ponder_stats = SearchStats()
+            root = self.reuse_tree(state, player)
+            if root is None:
+                snapshot = state.copy()
+                if self.config.event_weights is not None:
+                    snapshot.event_weights = self.config.event_weights
+                root = MCTSNode(snapshot, player, table=self.table, config=self.config, store=self.value_store)
+            # 对手的每个行动都展开，无论对手走哪一步都有对应的子树可以复用
+            root.widening = False
+            self.tree = mcts_search(state, player, max_iterations, None, yield_fn, root, self.rollout_batch,
+                                    self.table, self.ponder_stats, self.config, stop_fn)
+            if self.tree.children:
+                self.ponder_share = self.tree.visits / len(self.tree.children)
+        finally:
+            self.pondering = False
+
+    def get_action(self, state, iterations=None, think_ms=None, yield_fn=None):
+        """选择行动：开局库中有该局面时直接返回库中的行动，否则搜索到迭代上限或思考时间用完为止，返回当前最优行动"""
+        if self.opening_book is not None:
+            move = self.opening_book.lookup(state)
+            if move is not None and (move[0] != "occupy" or state.is_valid_position(move[1])):
+                self.last_stats = SearchStats()
+                return move
+        stats = self.search(state,
+                            iterations if iterations is not None else self.iterations,
+                            think_ms if think_ms is not None else self.think_ms,
+                            yield_fn)
 
         # 平衡探索和利用
         if random.random() < self.epsilon:
-            return random.choice(state.available_moves(self.name))
+            return random.choice(state.executable_moves(self.name))
         
-        best_child = max(root.children, key=lambda c: c.visits)
-        move = best_child.move
+        return max(stats, key=lambda m: stats[m][0])
+
+# 把状态事件通过房间（GameRoom.emit）发送到前端：先发出积压的状态更新，保证前端按发生顺序收到
+class SocketIOEventSink(GameEventSink):
+    def __init__(self, room):
+        self.room = room
+
+    def event_triggered(self, state, event, remaining):
+        self.room.emit('event_triggered', {
+            'name': event.name,
+            'description': event.description,
+            'type': event.type,
+            'duration': remaining  # 发送剩余持续回合数
+        })
+
+    def extra_build_available(self, state, player):
+        self.room.emit('extra_build_available', {'player': player})
+
+# 运行指标，以Prometheus文本格式在/metrics输出
+class Metrics:
+    # 处理函数耗时直方图的分桶上限（秒）
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.search = SearchStats()  # 所有AI决策的累计搜索统计
+        self.decisions = 0
+        self.decision_seconds = 0.0
+        self.last_tree_size = 0
+        self.last_max_depth = 0
+        self.ponder_iterations = 0
+        self.handlers: Dict[str, List] = {}  # 事件名 -> [各分桶计数, 总次数, 总耗时]
+
+    def record_decision(self, stats: SearchStats, seconds):
+        with self.lock:
+            self.search.merge(stats)
+            self.decisions += 1
+            self.decision_seconds += seconds
+            self.last_tree_size = stats.tree_size
+            self.last_max_depth = stats.max_depth
+
+    def record_ponder(self, stats: SearchStats):
+        with self.lock:
+            self.ponder_iterations += stats.iterations
+
+    def observe_handler(self, event, seconds):
+        with self.lock:
+            entry = self.handlers.get(event)
+            if entry is None:
+                entry = self.handlers[event] = [[0] * len(self.BUCKETS), 0, 0.0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    entry[0][i] += 1
+            entry[1] += 1
+            entry[2] += seconds
+
+    def render(self, rooms):
+        with self.lock:
+            search = self.search
+            lines = [
+                "# HELP mcts_phase_seconds_total Time spent in each MCTS phase.",
+                "# TYPE mcts_phase_seconds_total counter",
+                f'mcts_phase_seconds_total{{phase="selection"}} {search.selection_time}',
+                f'mcts_phase_seconds_total{{phase="expansion"}} {search.expansion_time}',
+                f'mcts_phase_seconds_total{{phase="simulation"}} {search.simulation_time}',
+                f'mcts_phase_seconds_total{{phase="backpropagation"}} {search.backpropagation_time}',
+                "# HELP mcts_decisions_total AI decisions made.",
+                "# TYPE mcts_decisions_total counter",
+                f"mcts_decisions_total {self.decisions}",
+                "# HELP mcts_ponder_iterations_total MCTS iterations run while the human was thinking.",
+                "# TYPE mcts_ponder_iterations_total counter",
+                f"mcts_ponder_iterations_total {self.ponder_iterations}",
+                "# HELP mcts_decision_seconds_total Wall time spent in GameAI.get_action.",
+                "# TYPE mcts_decision_seconds_total counter",
+                f"mcts_decision_seconds_total {self.decision_seconds}",
+                "# HELP mcts_iterations_total MCTS iterations completed.",
+                "# TYPE mcts_iterations_total counter",
+                f"mcts_iterations_total {search.iterations}",
+                "# HELP mcts_nodes_created_total Tree nodes created.",
+                "# TYPE mcts_nodes_created_total counter",
+                f"mcts_nodes_created_total {search.nodes_created}",
+                "# HELP mcts_rollouts_total Rollouts played.",
+                "# TYPE mcts_rollouts_total counter",
+                f"mcts_rollouts_total {search.rollouts}",
+                "# HELP mcts_rollout_plies_total Moves played inside rollouts.",
+                "# TYPE mcts_rollout_plies_total counter",
+                f"mcts_rollout_plies_total {search.rollout_plies}",
+                "# HELP mcts_value_cutoffs_total Simulations replaced by a value store estimate.",
+                "# TYPE mcts_value_cutoffs_total counter",
+                f"mcts_value_cutoffs_total {search.value_cutoffs}",
+                "# HELP mcts_state_copies_total GameState copies made by the search.",
+                "# TYPE mcts_state_copies_total counter",
+                f"mcts_state_copies_total {search.state_copies}",
+                "# HELP mcts_tree_size Nodes in the tree after the last decision.",
+                "# TYPE mcts_tree_size gauge",
+                f"mcts_tree_size {self.last_tree_size}",
+                "# HELP mcts_max_depth Deepest selection path of the last decision.",
+                "# TYPE mcts_max_depth gauge",
+                f"mcts_max_depth {self.last_max_depth}",
+                "# HELP game_rooms Rooms currently open.",
+                "# TYPE game_rooms gauge",
+                f"game_rooms {rooms}",
+                "# HELP socketio_handler_seconds Socket.IO handler latency.",
+                "# TYPE socketio_handler_seconds histogram",
+            ]
+            for event, (buckets, count, total) in sorted(self.handlers.items()):
+                for bound, value in zip(self.BUCKETS, buckets):
+                    lines.append(f'socketio_handler_seconds_bucket{{event="{event}",le="{bound}"}} {value}')
+                lines.append(f'socketio_handler_seconds_bucket{{event="{event}",le="+Inf"}} {count}')
+                lines.append(f'socketio_handler_seconds_sum{{event="{event}"}} {total}')
+                lines.append(f'socketio_handler_seconds_count{{event="{event}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def timed_handler(event):
+    """记录Socket.IO处理函数的耗时"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metrics.observe_handler(event, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+# AI配置：每步思考2秒（原先是固定等待2秒再做150次迭代）
+AI_THINK_MS = 2000
+# 玩家思考时AI在后台搜索的迭代上限由每个房间的内存预算决定：用tracemalloc测得9x9三人对局中
+# 后台思考的搜索树每次迭代约占10KB（5000次迭代约49MB）。16MB约1600次迭代，对手每个行动约21次访问
+AI_PONDER_MEMORY_MB = 16
+PONDER_BYTES_PER_ITERATION = 10_000
+AI_PONDER_ITERATIONS = AI_PONDER_MEMORY_MB * 1_000_000 // PONDER_BYTES_PER_ITERATION
+# 后台思考充分时的思考时间
+AI_PONDER_THINK_MS = 500
+# 同时后台思考的房间数上限。线程模式下所有房间共享GIL，后台思考会挤占其他房间
+# AI回合（受思考时间限制）的CPU时间，因此还要在任何房间的AI回合进行中时暂停
+AI_MAX_PONDERING = 2
+PONDER_PAUSE = 0.01
+
+class PonderScheduler:
+    """所有房间共用的后台思考调度：限制同时思考的房间数，AI回合进行中时让后台思考暂停"""
+
+    def __init__(self, slots):
+        self.slots = threading.BoundedSemaphore(slots)
+        self.lock = threading.Lock()
+        self.ai_turns = 0  # 正在进行的AI回合数
+
+    def ai_turn_started(self):
+        with self.lock:
+            self.ai_turns += 1
+
+    def ai_turn_finished(self):
+        with self.lock:
+            self.ai_turns -= 1
+
+    def acquire(self, stopped):
+        """等待思考名额，直到取得（返回True）或stopped()为真（返回False）"""
+        while not self.slots.acquire(blocking=False):
+            if stopped():
+                return False
+            socketio.sleep(PONDER_PAUSE)
+        return True
+
+    def release(self):
+        self.slots.release()
+
+    def yield_fn(self, stopped):
+        """后台搜索的让出函数：有AI回合在进行时一直等待，直到它们结束或stopped()为真"""
+        def yield_fn():
+            socketio.sleep(0)
+            while self.ai_turns and not stopped():
+                socketio.sleep(PONDER_PAUSE)
+        return yield_fn
+
+ponder_scheduler = PonderScheduler(AI_MAX_PONDERING)
+# 运行时写入的数据（价值库）所在目录，可用环境变量TERRITORY_DATA_DIR指定，默认为用户数据目录
+DATA_DIR = os.environ.get("TERRITORY_DATA_DIR") or os.path.join(
+    os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share"), "territory")
+# 所有房间的AI共用的价值库，每局结束时记入终局得分；多个服务器进程可以指向同一个文件
+VALUE_STORE_PATH = os.environ.get("TERRITORY_VALUE_STORE") or os.path.join(DATA_DIR, "values.tvs")
+value_store = ValueStore(VALUE_STORE_PATH)
+# 由book.py离线生成的开局库，只读；存在时新对局从库中的河流布局里选取，AI开局的几步直接查库
+OPENING_BOOK_PATH = os.environ.get("TERRITORY_OPENING_BOOK") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "opening.tob")
+opening_book = OpeningBook(OPENING_BOOK_PATH)
+
+def create_ai_players():
+    ais = [GameAI("AI1", iterations=None, think_ms=AI_THINK_MS, value_store=value_store, opening_book=opening_book),
+           GameAI("AI2", iterations=None, think_ms=AI_THINK_MS, value_store=value_store, opening_book=opening_book)]
+    for ai in ais:
+        ai.ponder_think_ms = AI_PONDER_THINK_MS
+    return ais
+
+def active_events_payload(state, current_round):
+    """当前有效事件的前端格式"""
+    return [
+        {
+            'name': event.name,
+            'description': event.description,
+            'type': event.type,
+            'duration': event.duration - current_round  # 计算剩余回合数
+        }
+        for event in state.active_events.values()
+        if event.duration > current_round  # 只显示未过期的事件
+    ]
+
+# 二进制状态帧（连接参数 wire=binary 的客户端以'frame'事件接收），整数均为小端序
+# 帧头: 类型(u8), 版本(u32), 基准版本(u32), 回合(u16), 大回合(u8), 最大回合数(u8), 当前玩家序号(u8), 标志(u8)
+# 完整状态（类型1为加入或补发，3为开局）之后为: 玩家数(u8)和各玩家名(u8长度 + UTF-8)，棋盘大小(u8)，
+#   每格一字节的棋盘（与GameState.board相同: 0空地, 1河流, 2 + 玩家序号），各玩家的木材和金币(u16, u16)，事件列表
+# 增量（类型2）之后为: 格子数(u16)和各格子的序号(u16)与编码(u8)，资源变化的玩家数(u8)和
+#   各玩家的序号(u8)与木材、金币变化(i16, i16)，有事件标志时为事件列表，有消息标志时为消息(u16长度 + UTF-8)
+# 事件列表: 事件数(u8)和各事件在目录中的序号(u8)与剩余回合(u8)；目录在连接时以'event_catalog'发送一次
+WIRE_SNAPSHOT = 1
+WIRE_PATCH = 2
+WIRE_GAME_STARTED = 3
+WIRE_HAS_EVENTS = 0x01
+WIRE_HAS_MESSAGE = 0x02
+WIRE_NO_PLAYER = 0xFF
+_WIRE_HEADER = struct.Struct("<BIIHBBBB")
+EVENT_WIRE_CATALOG = [{'name': e.name, 'description': e.description, 'type': e.type} for e in EVENT_CATALOG.values()]
+
+def _wire_header(kind, base, version, header, players, flags):
+    current = header.get('currentPlayer')
+    return bytearray(_WIRE_HEADER.pack(kind, version, base, header.get('turn', 0), header.get('round', 0),
+                                       header.get('maxRounds', 0),
+                                       players.index(current) if current in players else WIRE_NO_PLAYER, flags))
+
+def _wire_events(frame, events):
+    frame.append(len(events))
+    for event in events:
+        frame.append(_EVENT_INDEX[event['name']])
+        frame.append(max(event['duration'], 0))
+
+def encode_snapshot(state, board, resources, header, version, events, kind=WIRE_SNAPSHOT):
+    """完整状态的二进制帧：玩家和棋盘大小取自state，棋盘和资源用已发布版本的board和resources"""
+    players = state.players
+    frame = _wire_header(kind, version, version, header, players, WIRE_HAS_EVENTS)
+    frame.append(len(players))
+    for p in players:
+        name = p.encode("utf-8")
+        frame.append(len(name))
+        frame += name
+    frame.append(state.grid_size)
+    frame += board
+    for p in players:
+        frame += struct.pack("<HH", resources[p]["wood"], resources[p]["gold"])
+    _wire_events(frame, events)
+    return bytes(frame)
+
+def encode_patch(players, grid_size, patch):
+    """增量的二进制帧，players为开局时的玩家顺序"""
+    flags = (WIRE_HAS_EVENTS if 'active_events' in patch else 0) | (WIRE_HAS_MESSAGE if patch.get('message') else 0)
+    frame = _wire_header(WIRE_PATCH, patch['base'], patch['version'], patch, players, flags)
+    frame += struct.pack("<H", len(patch['cells']))
+    for x, y, player in patch['cells']:
+        frame += struct.pack("<HB", y * grid_size + x, PLAYER_BASE + players.index(player))
+    frame.append(len(patch['resources']))
+    for p, delta in patch['resources'].items():
+        frame += struct.pack("<Bhh", players.index(p), delta.get('wood', 0), delta.get('gold', 0))
+    if flags & WIRE_HAS_EVENTS:
+        _wire_events(frame, patch['active_events'])
+    if flags & WIRE_HAS_MESSAGE:
+        message = patch['message'].encode("utf-8")
+        frame += struct.pack("<H", len(message)) + message
+    return bytes(frame)
+
+def merge_patches(patches):
+    """把连续的增量合并为一个：格子取最后的值，资源变化相加，事件列表和其余字段取最后一个增量的"""
+    merged = dict(patches[-1])
+    merged['base'] = patches[0]['base']
+    cells = {}
+    resources: Dict[str, Dict[str, int]] = {}
+    for patch in patches:
+        for x, y, value in patch['cells']:
+            cells[(x, y)] = value
+        for p, delta in patch['resources'].items():
+            for r, v in delta.items():
+                resources.setdefault(p, {})[r] = resources.get(p, {}).get(r, 0) + v
+        if 'active_events' in patch:
+            merged['active_events'] = patch['active_events']
+    merged['cells'] = [[x, y, value] for (x, y), value in cells.items()]
+    merged['resources'] = resources
+    return merged
+
+# 一个房间内的一局游戏，房间号默认由创建者的sid生成
+class GameRoom:
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.state: Optional[GameState] = None
+        self.players: List[str] = []  # 房间内的人类玩家
+        self.player_sid: Optional[str] = None  # 人类玩家的连接，其余连接为观战者
+        self.members = set()  # 房间内所有连接的sid
+        self.binary_members = set()  # 其中接收二进制状态帧的连接
+        # 状态更新按连接的格式分两个频道发送，每种格式每帧只编码一次
+        self.json_channel = room_id + '#json'
+        self.binary_channel = room_id + '#bin'
+        self.ai_players = create_ai_players()  # 每个房间独立的AI（各自保留搜索树和置换表）
+        self.ai_running = False  # AI回合是否在后台进行
+        self.ponder_token = None  # 当前后台思考的标记，替换或清空即通知其停止
+        self.reset_updates()
+
+    def reset_updates(self):
+        """新的一局：状态版本从0开始，清空已发送内容的记录"""
+        self.version = 0
+        self.header = {}  # 最近一次发送的回合、当前玩家等字段
+        self.sent_moves = 0  # 已发送到前端的行动数
+        # 最近发布的版本的棋盘和资源。AI回合中apply_move和publish之间可能有连接或补发请求插入，
+        # 完整状态因此不能取自实时的state，否则与版本号不符，之后的增量会被重复应用
+        self.sent_board = b""
+        self.sent_resources = {}
+        self.sent_events = []
+        self.history = deque(maxlen=32)  # 最近的增量，用于断线后补发
+        self.pending = []  # 已生成还没发送的增量，flush时合并成一帧
+
+    def start_pondering(self, state):
+        """轮到人类玩家时，让紧接着行动的AI在后台搜索，直到玩家行动或游戏重新开始"""
+        n = len(state.players)
+        human = state.players[state.turn % n]
+        next_player = state.players[(state.turn + 1) % n]
+        ai = next((ai for ai in self.ai_players if ai.name == next_player), None)
+        if ai is None or not ai.can_ponder():
+            return
+        token = self.ponder_token = object()
         
-        # 更新Q值
-        state_hash = str(state.grid) + str(state.resources[self.name])
-        next_state = state.copy()
-        next_state.apply_move(self.name, move)
-        next_hash = str(next_state.grid) + str(next_state.resources[self.name])
+        def stopped():
+            return self.ponder_token is not token or self.state is not state
         
-        # 使用综合评分作为奖励
-        reward = next_state.calculate_score(self.name) - state.calculate_score(self.name)
+        def task():
+            # 同一个AI上一次的后台思考可能还没退出
+            while ai.pondering:
+                socketio.sleep(0.001)
+            # 名额已满时等其他房间的后台思考结束
+            if stopped() or not ponder_scheduler.acquire(stopped):
+                return
+            try:
+                ai.ponder(state, human, stopped, ponder_scheduler.yield_fn(stopped), AI_PONDER_ITERATIONS)
+            finally:
+                ponder_scheduler.release()
+            metrics.record_ponder(ai.ponder_stats)
+        socketio.start_background_task(task)
+
+    def stop_pondering(self):
+        self.ponder_token = None
+
+    def emit(self, event, data):
+        # 先发出积压的状态更新，保证前端按发生顺序收到
+        self.flush()
+        socketio.emit(event, data, to=self.room_id)
+
+    def send_state(self, event, payload, frame, to=None):
+        """发送状态更新：payload()为JSON格式，frame()为二进制帧，只为有接收者的格式编码
         
-        self.q_table[(state_hash, move)] += self.learning_rate * (
-            reward + self.discount * max(
-                [self.q_table[(next_hash, m)] for m in next_state.available_moves(self.name)],
-                default=0
-            ) - self.q_table[(state_hash, move)]
-        )
+        to为空时发给房间内的所有连接，否则只发给该sid。
+        """
+        if to is not None:
+            if to in self.binary_members:
+                socketio.emit('frame', frame(), to=to)
+            else:
+                socketio.emit(event, payload(), to=to)
+            return
+        if len(self.members) > len(self.binary_members):
+            socketio.emit(event, payload(), to=self.json_channel)
+        if self.binary_members:
+            socketio.emit('frame', frame(), to=self.binary_channel)
+
+    def send_snapshot(self, event='update', to=None):
+        kind = WIRE_GAME_STARTED if event == 'game_started' else WIRE_SNAPSHOT
+        self.send_state(event, self.snapshot,
+                        lambda: encode_snapshot(self.state, self.sent_board, self.sent_resources, self.header,
+                                                self.version, self.sent_events, kind), to)
+
+    def send_patch(self, patch, to=None):
+        state = self.state
+        self.send_state('patch', lambda: patch, lambda: encode_patch(state.players, state.grid_size, patch), to)
+
+    def flush(self):
+        """把积压的增量合并成一帧发送；连续的更新（如AI思考中紧接着AI行动后的状态）因此只发送一次"""
+        if not self.pending:
+            return
+        patches, self.pending = self.pending, []
+        if self.state is not None:
+            self.send_patch(merge_patches(patches))
+
+    def current_round(self):
+        return (self.state.turn // len(self.state.players)) + 1
+
+    def current_player(self):
+        return self.state.players[self.state.turn % len(self.state.players)]
+
+    def publish(self, current_player, current_round, message=None):
+        """生成自上一版本以来的增量：新占领的格子、资源变化和有变化的事件列表，在下一次flush时发送"""
+        state = self.state
+        patch = {
+            'base': self.version,
+            'version': self.version + 1,
+            'turn': state.turn,
+            'currentPlayer': current_player,
+            'round': current_round,
+            'maxRounds': 20,
+            'cells': [[position[0], position[1], player]
+                      for player, (action, position) in state.moves[self.sent_moves:]
+                      if action == "occupy"],
+            'resources': {}
+        }
+        if message:
+            patch['message'] = message
+        for p, resources in state.resources.items():
+            sent = self.sent_resources.get(p, {})
+            delta = {r: v - sent.get(r, 0) for r, v in resources.items() if v != sent.get(r, 0)}
+            if delta:
+                patch['resources'][p] = delta
+        active_events = active_events_payload(state, current_round)
+        if active_events != self.sent_events:
+            patch['active_events'] = active_events
         
-        return move
+        self.version += 1
+        self.header = {k: patch[k] for k in ('turn', 'currentPlayer', 'round', 'maxRounds')}
+        self.sent_moves = len(state.moves)
+        self.sent_board = bytes(state.board)
+        self.sent_resources = {p: r.copy() for p, r in state.resources.items()}
+        self.sent_events = active_events
+        self.history.append(patch)
+        self.pending.append(patch)
 
-# 游戏服务器
+    def snapshot(self):
+        """最近发布的版本的完整状态，只在开局、加入房间和补发失败时发送"""
+        payload = dict(self.header)
+        payload.update({
+            'version': self.version,
+            'grid': self.state.board_grid(self.sent_board),
+            'resources': self.sent_resources,
+            'active_events': self.sent_events
+        })
+        return payload
+
+    def patch_since(self, version):
+        """合并version之后的所有增量；历史中已没有该版本时返回None"""
+        patches = [patch for patch in self.history if patch['base'] >= version]
+        if not patches or patches[0]['base'] != version:
+            return None
+        return merge_patches(patches)
+
+# 游戏服务器：按房间管理多局同时进行的游戏
 class GameServer:
     def __init__(self):
-        self.state = None
-        self.players = []
-        self.ai_players = []
+        self.rooms: Dict[str, GameRoom] = {}
+        self.sid_rooms: Dict[str, str] = {}  # 连接sid -> 房间号
+
+    def join(self, sid, room_id, binary=False):
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self.rooms[room_id] = GameRoom(room_id)
+        room.members.add(sid)
+        if binary:
+            room.binary_members.add(sid)
+        self.sid_rooms[sid] = room_id
+        return room
+
+    def leave(self, sid):
+        room = self.rooms.get(self.sid_rooms.pop(sid, None))
+        if room is None:
+            return
+        room.members.discard(sid)
+        room.binary_members.discard(sid)
+        if sid == room.player_sid:
+            room.player_sid = None
+            room.players.clear()
+        if not room.members:
+            # 房间里没人了：丢弃这局游戏，正在进行的AI回合会在下一步检查时退出
+            room.state = None
+            del self.rooms[room.room_id]
+
+    def room_of(self, sid) -> Optional[GameRoom]:
+        return self.rooms.get(self.sid_rooms.get(sid))
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(len(server.rooms)), mimetype='text/plain; version=0.0.4')
+
 @socketio.on('connect')
 def handle_connect():
     print('Player connected')
-    server.players.append("player")
-    emit('player_id', "player")
+    # 通过连接参数 ?room=xxx 加入已有房间，否则按自己的sid新建房间；?wire=binary 时状态更新以二进制帧发送
+    room_id = request.args.get('room') or 'room-' + request.sid
+    binary = request.args.get('wire') == 'binary'
+    join_room(room_id)
+    room = server.join(request.sid, room_id, binary)
+    join_room(room.binary_channel if binary else room.json_channel)
+    emit('room_joined', room_id)
+    if binary:
+        emit('event_catalog', EVENT_WIRE_CATALOG)
+    if room.player_sid is None:
+        room.player_sid = request.sid
+        room.players = ["player"]
+        emit('player_id', "player")
+    else:
+        emit('player_id', None)  # 房间已有玩家，以观战者身份加入
+    if room.state:
+        room.flush()
+        room.send_snapshot(to=request.sid)
+
+@socketio.on('resync')
+def handle_resync(data=None):
+    """客户端发现版本不连续时请求补发：优先补发合并后的增量，否则发送完整状态"""
+    room = server.room_of(request.sid)
+    if not (room and room.state):
+        return
+    room.flush()
+    version = (data or {}).get('version')
+    patch = room.patch_since(version) if version is not None else None
+    if patch:
+        room.send_patch(patch, to=request.sid)
+    else:
+        room.send_snapshot(to=request.sid)
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    server.leave(request.sid)
 
 @socketio.on('start_game')
+@timed_handler('start_game')
 def start_game():
-    if len(server.players) + len(server.ai_players) >= 2:
-        all_players = server.players + [ai.name for ai in server.ai_players]
-        server.state = GameState(grid_size=9, players=all_players)
+    room = server.room_of(request.sid)
+    if room and request.sid == room.player_sid and room.ai_running:
+        emit('error', 'AI is thinking')  # AI回合结束后才能开始新的一局
+        return
+    if room and request.sid == room.player_sid and len(room.players) + len(room.ai_players) >= 2:
+        all_players = room.players + [ai.name for ai in room.ai_players]
+        room.stop_pondering()
+        room.ai_players = create_ai_players()
+        room.state = GameState(grid_size=9, players=all_players, sink=SocketIOEventSink(room),
+                               seed=opening_book.random_seed(9, len(all_players)))
         # 游戏开始时触发第一个事件
-        new_event = server.state.check_and_trigger_events()
+        new_event = room.state.check_and_trigger_events()
         
         # 计算当前回合数
         current_round = 1
         
-        # 获取当前有效的事件
-        active_events = [
-            {
-                'name': event.name,
-                'description': event.description,
-                'type': event.type,
-                'duration': event.duration - current_round  # 计算剩余回合数
-            }
-            for event in server.state.active_events.values()
-            if event.duration > current_round  # 只显示未过期的事件
-        ]
-        
-        emit('game_started', {
-            'grid': server.state.grid,
-            'resources': server.state.resources,
-            'round': current_round,
-            'maxRounds': 20,
-            'currentPlayer': all_players[0],
-            'active_events': active_events
-        }, broadcast=True)
+        # 开局发送完整状态，之后只发送增量
+        room.reset_updates()
+        room.header = {'turn': 0, 'currentPlayer': all_players[0], 'round': current_round, 'maxRounds': 20}
+        room.sent_board = bytes(room.state.board)
+        room.sent_resources = {p: r.copy() for p, r in room.state.resources.items()}
+        room.sent_events = active_events_payload(room.state, current_round)
+        room.send_snapshot('game_started')
         
         # 如果有事件触发，发送事件通知
         if new_event:
-            emit('event_triggered', {
+            room.emit('event_triggered', {
                 'name': new_event.name,
                 'description': new_event.description,
                 'type': new_event.type,
                 'duration': new_event.duration
-            }, broadcast=True)
+            })
+        if room.current_player() in room.players:
+            room.start_pondering(room.state)
     else:
         emit('error', 'Not enough players')
 
 @socketio.on('move')
+@timed_handler('move')
 def handle_move(data):
+    room = server.room_of(request.sid)
     player = data['player']
     action = data['action']
     position = tuple(data['position']) if data.get('position') else None
-    if server.state and player in server.state.players:
-        # 如果行动失败(比如点击河流),不增加回合数
-        if server.state.apply_move(player, (action, position)) is False:
-            # 发送错误消息和当前状态
-            emit('error', '无法在河流上建造!', broadcast=True)
-            # 计算当前回合数
-            current_round = (server.state.turn // len(server.players)) + 1
+    if not (room and room.state and request.sid == room.player_sid and player in room.players):
+        return
+    if room.ai_running or room.current_player() != player:
+        emit('error', '还没轮到你行动')
+        return
+    room.stop_pondering()
+    
+    # 如果行动失败(比如点击河流),不增加回合数
+    if room.state.apply_move(player, (action, position)) is False:
+        # 发送错误消息和当前状态
+        room.emit('error', '无法在河流上建造!')
+        room.publish(player, room.current_round())  # 保持当前玩家
+        room.flush()
+        room.start_pondering(room.state)  # 仍是玩家的回合，继续后台思考
+        return  # 直接返回，不执行后续逻辑
+    
+    # 行动成功，发送更新状态
+    room.publish(room.current_player(), room.current_round())
+    room.flush()
+    if room.state.is_game_over():
+        room.emit('game_over', {'winner': room.state.get_winner()})
+        learn_game(room.state)
+    else:
+        # AI回合在后台任务中进行，处理函数立即返回，不阻塞其他房间
+        room.ai_running = True
+        ponder_scheduler.ai_turn_started()
+        socketio.start_background_task(run_ai_turns, room, room.state)
+
+learn_queue = queue.Queue()
+learn_worker_lock = threading.Lock()
+learn_worker_started = False
+
+def learn_worker():
+    """后台逐局写入价值库：重放对局和加锁写文件都不占用事件处理和AI回合的线程"""
+    while True:
+        log = learn_queue.get()
+        try:
+            value_store.learn(log)
+        except (OSError, ValueError) as e:
+            print(f"价值库写入失败: {e}")
+        finally:
+            learn_queue.task_done()
+
+def learn_game(state):
+    """把结束的对局交给后台线程记入价值库；价值库出错不影响游戏"""
+    global learn_worker_started
+    learn_queue.put(bytes(state.log))
+    with learn_worker_lock:
+        if not learn_worker_started:
+            learn_worker_started = True
+            socketio.start_background_task(learn_worker)
+
+def run_ai_turns(room, state):
+    """依次执行房间内AI的回合
+    
+    搜索中每隔YIELD_INTERVAL通过socketio.sleep(0)让出控制权，
+    多个房间的AI回合因此轮流推进，一个耗时的搜索不会独占服务器。
+    状态更新在让出控制权时和结束时才发送：AI很快决定（如查到开局库）时，
+    "思考中"、行动后的状态和下一个AI的"思考中"合并为一帧。
+    """
+    ais = {ai.name: ai for ai in room.ai_players}
+    
+    def yield_fn():
+        room.flush()
+        socketio.sleep(0)
+    
+    try:
+        # 等后台思考在当前迭代结束后退出，搜索树交回给get_action
+        while any(ai.pondering for ai in ais.values()):
+            socketio.sleep(0.001)
+        # 轮到AI时一直由AI行动；游戏已重新开始或房间已关闭时退出
+        while room.state is state and not state.is_game_over() and room.current_player() in ais:
+            ai = ais[room.current_player()]
+            # 计算当前回合数（基于玩家数量）
+            current_round = min(room.current_round(), 20)  # 最大回合数限制
             
-            # 获取当前有效的事件
-            active_events = [
-                {
-                    'name': event.name,
-                    'description': event.description,
-                    'type': event.type,
-                    'duration': event.duration - current_round  # 计算剩余回合数
-                }
-                for event in server.state.active_events.values()
-                if event.duration > current_round  # 只显示未过期的事件
-            ]
+            # 发送AI思考中的状态
+            room.publish(ai.name, current_round, message='AI思考中...')
             
-            emit('update', {
-                'grid': server.state.grid,
-                'resources': server.state.resources,
-                'turn': server.state.turn,
-                'currentPlayer': player,  # 保持当前玩家
-                'round': current_round,
-                'maxRounds': 20,
-                'active_events': active_events
-            }, broadcast=True)
-            return  # 直接返回，不执行后续逻辑
-        
-        # 行动成功，处理下一个玩家
-        next_player_index = (server.state.turn % len(server.state.players))
-        next_player = server.state.players[next_player_index]
-        
-        # 如果当前是AI2行动完，确保下一个是人类玩家
-        if player == "AI2":
-            next_player = "player"
-        
-        # 计算当前回合数
-        current_round = (server.state.turn // len(server.players)) + 1
-        
-        # 获取当前有效的事件
-        active_events = [
-            {
-                'name': event.name,
-                'description': event.description,
-                'type': event.type,
-                'duration': event.duration - current_round  # 计算剩余回合数
-            }
-            for event in server.state.active_events.values()
-            if event.duration > current_round  # 只显示未过期的事件
-        ]
-        
-        # 发送更新状态
-        emit('update', {
-            'grid': server.state.grid,
-            'resources': server.state.resources,
-            'turn': server.state.turn,
-            'currentPlayer': next_player,
-            'round': current_round,
-            'maxRounds': 20,
-            'active_events': active_events
-        }, broadcast=True)
-        if server.state.is_game_over():
-            emit('game_over', {'winner': server.state.get_winner()}, broadcast=True)
-        else:
-            # AI回合
-            for ai in server.ai_players:
-                if ai.name in server.state.players and not server.state.is_game_over():
-                    # 计算当前回合数（基于玩家数量）
-                    current_round = (server.state.turn // len(server.state.players)) + 1
-                    current_round = min(current_round, 20)  # 最大回合数限制
-                    
-                    # 发送AI思考中的状态
-                    emit('update', {
-                        'grid': server.state.grid,
-                        'resources': server.state.resources,
-                        'turn': server.state.turn,
-                        'currentPlayer': ai.name,
-                        'message': 'AI思考中...',
-                        'round': current_round,
-                        'maxRounds': 20
-                    }, broadcast=True)
-                    
-                    # 等待2秒
-                    socketio.sleep(2)
-                    
-                    # AI行动
-                    move = ai.get_action(server.state)
-                    server.state.apply_move(ai.name, move)
-                    
-                    # 发送AI行动后的状态
-                    next_player_index = (server.state.turn % len(server.state.players))
-                    next_player = server.state.players[next_player_index]
-                    
-                    # 如果当前AI是AI2，确保下一个是人类玩家
-                    if ai.name == "AI2":
-                        next_player = "player"
-                    
-                    # 计算当前回合数（基于玩家数量）
-                    current_round = (server.state.turn // len(server.state.players)) + 1
-                    current_round = min(current_round, 20)  # 最大回合数限制
-                    
-                    # 获取当前有效的事件
-                    active_events = [
-                        {
-                            'name': event.name,
-                            'description': event.description,
-                            'type': event.type,
-                            'duration': event.duration - current_round  # 计算剩余回合数
-                        }
-                        for event in server.state.active_events.values()
-                        if event.duration > current_round  # 只显示未过期的事件
-                    ]
-                    
-                    emit('update', {
-                        'grid': server.state.grid,
-                        'resources': server.state.resources,
-                        'turn': server.state.turn,
-                        'currentPlayer': next_player,
-                        'round': current_round,
-                        'maxRounds': 20,
-                        'active_events': active_events
-                    }, broadcast=True)
-                    if server.state.is_game_over():
-                        emit('game_over', {'winner': server.state.get_winner()}, broadcast=True)
-                        break
+            # AI行动：思考时间用于搜索，期间让出控制权保持socket响应
+            started = time.perf_counter()
+            move = ai.get_action(state, yield_fn=yield_fn)
+            metrics.record_decision(ai.last_stats, time.perf_counter() - started)
+            if room.state is not state:
+                break
+            if not state.apply_move(ai.name, move):
+                # get_action只返回可执行的行动，失败说明搜索有问题：记录下来，改为收集木材保证回合推进
+                print(f"{ai.name}的行动{move}无法执行，改为收集木材")
+                state.apply_move(ai.name, ("collect_wood", None))
+            
+            # 发送AI行动后的状态
+            current_round = min(room.current_round(), 20)  # 最大回合数限制
+            room.publish(room.current_player(), current_round)
+            if state.is_game_over():
+                room.emit('game_over', {'winner': state.get_winner()})
+                learn_game(state)
+        if room.state is state and not state.is_game_over():
+            room.start_pondering(state)
+    finally:
+        if room.state is state:
+            room.flush()
+        room.ai_running = False
+        ponder_scheduler.ai_turn_finished()
 
 server = GameServer()
-server.ai_players = [GameAI("AI1"), GameAI("AI2")]
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    socketio.run(app, debug=True, host='0.0.0.0', port=5000)
@@ -1,25 +1,170 @@
-const socket = io();
+// 通过页面参数 ?room=xxx 加入已有房间，否则服务器为本连接新建房间；状态更新使用二进制帧
+const room = new URLSearchParams(window.location.search).get('room');
+const socket = io({ query: room ? { room: room, wire: 'binary' } : { wire: 'binary' } });
 let playerId;
+let gameState = null;  // 最近一次完整状态，按版本号应用服务器发送的增量
+let resyncPending = false;
+let eventCatalog = [];  // 二进制帧中的事件序号 -> {name, description, type}
+let wirePlayers = [];  // 二进制帧中的玩家序号 -> 玩家名，随完整状态更新
 const canvas = document.getElementById('grid');
 const ctx = canvas.getContext('2d');
 const cellSize = 100; // 保持单元格大小不变，因为canvas已经扩大到900x900
 
 socket.on('player_id', (id) => {
     playerId = id;
-    document.getElementById('status').innerText = `Your ID: ${playerId}`;
+    document.getElementById('status').innerText = playerId ? `Your ID: ${playerId}` : '观战中';
 });
 
-socket.on('game_started', (data) => {
+// 把房间号写入地址栏，分享链接即可观战
+socket.on('room_joined', (roomId) => {
+    window.history.replaceState(null, '', `?room=${encodeURIComponent(roomId)}`);
+});
+
+function handleGameStarted(data) {
     // 清空事件面板
     const activeEvents = document.getElementById('active-events');
     activeEvents.innerHTML = '';
+    handleSnapshot(data);
+}
+
+// 完整状态：加入房间或补发时发送
+function handleSnapshot(data) {
+    gameState = data;
+    resyncPending = false;
     updateGame(data);
+}
+
+// 增量状态：版本不连续时请求服务器补发
+function handlePatch(patch) {
+    if (!gameState || patch.base !== gameState.version) {
+        if (!resyncPending) {
+            resyncPending = true;
+            socket.emit('resync', { version: gameState ? gameState.version : null });
+        }
+        return;
+    }
+    resyncPending = false;
+    applyPatch(gameState, patch);
+    updateGame(Object.assign({}, gameState, { message: patch.message }));
+}
+
+socket.on('game_started', handleGameStarted);
+socket.on('update', handleSnapshot);
+socket.on('patch', handlePatch);
+
+socket.on('event_catalog', (catalog) => {
+    eventCatalog = catalog;
 });
 
-socket.on('update', (data) => {
-    updateGame(data);
+// 二进制状态帧，格式见server.py中的encode_snapshot / encode_patch
+const WIRE_SNAPSHOT = 1, WIRE_PATCH = 2, WIRE_GAME_STARTED = 3;
+const WIRE_HAS_EVENTS = 0x01, WIRE_HAS_MESSAGE = 0x02, WIRE_NO_PLAYER = 0xFF;
+const textDecoder = new TextDecoder();
+
+socket.on('frame', (buffer) => {
+    const frame = decodeFrame(buffer);
+    if (frame.kind === WIRE_PATCH) {
+        handlePatch(frame.data);
+    } else if (frame.kind === WIRE_GAME_STARTED) {
+        handleGameStarted(frame.data);
+    } else {
+        handleSnapshot(frame.data);
+    }
 });
 
+function decodeFrame(buffer) {
+    const view = new DataView(buffer);
+    let offset = 0;
+    const u8 = () => view.getUint8(offset++);
+    const u16 = () => { const v = view.getUint16(offset, true); offset += 2; return v; };
+    const i16 = () => { const v = view.getInt16(offset, true); offset += 2; return v; };
+    const u32 = () => { const v = view.getUint32(offset, true); offset += 4; return v; };
+    const text = (length) => {
+        const value = textDecoder.decode(new Uint8Array(buffer, offset, length));
+        offset += length;
+        return value;
+    };
+    const events = () => {
+        const list = [];
+        for (let count = u8(); count > 0; count--) {
+            const event = eventCatalog[u8()] || { name: '', description: '', type: '' };
+            list.push(Object.assign({}, event, { duration: u8() }));
+        }
+        return list;
+    };
+    // 格子编码: 0空地, 1河流, 2 + 玩家序号
+    const cellValue = (code) => code === 0 ? null : code === 1 ? 'river' : wirePlayers[code - 2];
+
+    const kind = u8();
+    const version = u32();
+    const base = u32();
+    const data = { version: version, turn: u16(), round: u8(), maxRounds: u8() };
+    const current = u8();
+    const flags = u8();
+    if (kind === WIRE_PATCH) {
+        data.base = base;
+        data.currentPlayer = current === WIRE_NO_PLAYER ? null : wirePlayers[current];
+        data.cells = [];
+        for (let count = u16(); count > 0; count--) {
+            const index = u16();
+            const size = gameState ? gameState.grid.length : 1;
+            data.cells.push([index % size, Math.floor(index / size), cellValue(u8())]);
+        }
+        data.resources = {};
+        for (let count = u8(); count > 0; count--) {
+            const player = wirePlayers[u8()];
+            data.resources[player] = { wood: i16(), gold: i16() };
+        }
+        if (flags & WIRE_HAS_EVENTS) {
+            data.active_events = events();
+        }
+        if (flags & WIRE_HAS_MESSAGE) {
+            data.message = text(u16());
+        }
+        return { kind: kind, data: data };
+    }
+
+    wirePlayers = [];
+    for (let count = u8(); count > 0; count--) {
+        wirePlayers.push(text(u8()));
+    }
+    data.currentPlayer = current === WIRE_NO_PLAYER ? null : wirePlayers[current];
+    const size = u8();
+    data.grid = [];
+    for (let y = 0; y < size; y++) {
+        const row = [];
+        for (let x = 0; x < size; x++) {
+            row.push(cellValue(u8()));
+        }
+        data.grid.push(row);
+    }
+    data.resources = {};
+    wirePlayers.forEach((player) => {
+        data.resources[player] = { wood: u16(), gold: u16() };
+    });
+    data.active_events = events();
+    return { kind: kind, data: data };
+}
+
+function applyPatch(state, patch) {
+    patch.cells.forEach(([x, y, value]) => {
+        state.grid[y][x] = value;
+    });
+    for (let player in patch.resources) {
+        const delta = patch.resources[player];
+        state.resources[player].wood += delta.wood || 0;
+        state.resources[player].gold += delta.gold || 0;
+    }
+    if (patch.active_events) {
+        state.active_events = patch.active_events;
+    }
+    state.turn = patch.turn;
+    state.currentPlayer = patch.currentPlayer;
+    state.round = patch.round;
+    state.maxRounds = patch.maxRounds;
+    state.version = patch.version;
+}
+
 socket.on('game_over', (data) => {
     document.getElementById('status').innerText = `Game Over! Winner: ${data.winner}`;
 });
@@ -0,0 +1,290 @@
+"""GameState、对局记录、状态增量、价值库和开局库的测试
+
+用法:
+    python -m pytest -q
+"""
+import pickle
+import random
+import struct
+
+import pytest
+
+from server import (EMPTY, LOG_FAILED, PLAYER_BASE, SYMMETRY_SHIFT, GameRoom, GameState, OpeningBook, ValueStore,
+                    active_events_payload, canonical_key, encode_move, encode_patch, encode_snapshot,
+                    merge_patches, replay, store_key, transform_move)
+
+PLAYERS = ["player", "AI1", "AI2"]
+
+def invalid_position(state, rng):
+    """越界、河流或已占领的格子"""
+    size = state.grid_size
+    if rng.random() < 0.5:
+        return (rng.choice([-1, size]), rng.randrange(size))
+    idx = rng.choice([idx for idx, code in enumerate(state.board) if code != EMPTY])
+    return (idx % size, idx // size)
+
+def play(state, rng, moves=None, visit=None):
+    """按rng随机行动：有时先尝试无效的占领（失败的行动也会写入对局记录），再执行一个能成功的行动"""
+    n = len(state.players)
+    while not state.is_game_over() and (moves is None or moves > 0):
+        player = state.players[state.turn % n]
+        for _ in range(rng.randint(0, 2)):
+            assert not state.apply_move(player, ("occupy", invalid_position(state, rng)))
+        move = rng.choice(state.executable_moves(player))
+        assert state.apply_move(player, move)
+        if moves is not None:
+            moves -= 1
+        if visit is not None:
+            visit(state)
+    return state
+
+def new_game(seed, grid_size=9, players=PLAYERS):
+    state = GameState(grid_size, players, seed=random.Random(seed).getrandbits(64))
+    state.check_and_trigger_events()
+    return state
+
+@pytest.mark.parametrize("seed", range(5))
+def test_replay_reproduces_game(seed):
+    snapshots = {}
+    def visit(s):
+        snapshots[s.turn] = (bytes(s.board), {p: r.copy() for p, r in s.resources.items()}, s.zobrist)
+    state = play(new_game(seed), random.Random(seed), visit=visit)
+    replayed = replay(state.log)
+    assert replayed.board == state.board
+    assert replayed.resources == state.resources
+    assert replayed.zobrist == state.zobrist
+    assert replayed.moves == state.moves
+    assert [(e.name, e.duration) for e in replayed.event_history] == [(e.name, e.duration) for e in state.event_history]
+    for turn in (1, 7, len(state.moves) // 2):
+        partial = replay(state.log, turn)
+        assert partial.turn == turn
+        assert (bytes(partial.board), partial.resources, partial.zobrist) == snapshots[turn]
+
+def test_replay_rejects_mismatched_log():
+    state = play(new_game(1), random.Random(1), moves=10)
+    assert state.apply_move(state.players[state.turn % 3], ("collect_wood", None))
+    log = bytearray(state.log)
+    log[-1] |= LOG_FAILED  # 把最后一个成功的行动记为失败
+    with pytest.raises(ValueError):
+        replay(log)
+
+@pytest.mark.parametrize("grid_size", [9, 19])
+def test_zobrist_matches_compute_zobrist(grid_size):
+    state = new_game(grid_size, grid_size)
+    rng = random.Random(grid_size)
+    while not state.is_game_over():
+        play(state, rng, moves=1)
+        assert state.zobrist == state.compute_zobrist()
+        copy = state.copy()
+        assert copy.zobrist == state.zobrist
+
+def test_copy_on_write_isolation():
+    state = play(new_game(2), random.Random(2), moves=12)
+    before = (bytes(state.board), {p: r.copy() for p, r in state.resources.items()}, dict(state.active_events),
+              list(state.moves), set(state.empty_cells), dict(state.territory), state.zobrist)
+    copy = state.copy()
+    play(copy, random.Random(3), moves=15)
+    after = (bytes(state.board), state.resources, state.active_events, state.moves, state.empty_cells,
+             state.territory, state.zobrist)
+    assert after == before
+    # 原局面继续行动也不影响已有的副本
+    copy_before = (bytes(copy.board), {p: r.copy() for p, r in copy.resources.items()}, list(copy.moves))
+    play(state, random.Random(4), moves=15)
+    assert (bytes(copy.board), copy.resources, copy.moves) == copy_before
+
+def test_pickle_round_trip():
+    state = play(new_game(3), random.Random(3), moves=10)
+    restored = pickle.loads(pickle.dumps(state))
+    assert restored.board == state.board
+    assert restored.resources == state.resources
+    assert restored.zobrist == state.zobrist
+    assert restored.log is None
+    play(restored, random.Random(5), moves=5)
+    assert restored.zobrist == restored.compute_zobrist()
+
+def start_room(seed):
+    """与start_game相同地初始化房间，不经过Socket.IO"""
+    room = GameRoom("test")
+    room.state = new_game(seed)
+    room.reset_updates()
+    room.header = {'turn': 0, 'currentPlayer': PLAYERS[0], 'round': 1, 'maxRounds': 20}
+    room.sent_board = bytes(room.state.board)
+    room.sent_resources = {p: r.copy() for p, r in room.state.resources.items()}
+    room.sent_events = active_events_payload(room.state, 1)
+    return room
+
+def apply_patch(snapshot, patch):
+    assert patch['base'] == snapshot['version']
+    snapshot = dict(snapshot, version=patch['version'], grid=[row[:] for row in snapshot['grid']],
+                    resources={p: r.copy() for p, r in snapshot['resources'].items()})
+    for key in ('turn', 'currentPlayer', 'round', 'maxRounds'):
+        snapshot[key] = patch[key]
+    for x, y, player in patch['cells']:
+        snapshot['grid'][y][x] = player
+    for p, delta in patch['resources'].items():
+        for r, v in delta.items():
+            snapshot['resources'][p][r] += v
+    if 'active_events' in patch:
+        snapshot['active_events'] = patch['active_events']
+    return snapshot
+
+@pytest.mark.parametrize("seed", range(3))
+def test_patches_rebuild_snapshot(seed):
+    room = start_room(seed)
+    initial = room.snapshot()
+    rng = random.Random(seed)
+    for _ in range(20):
+        play(room.state, rng, moves=1)
+        room.publish(room.current_player(), room.current_round())
+    patches = room.pending
+    rebuilt = initial
+    for patch in patches:
+        rebuilt = apply_patch(rebuilt, patch)
+    assert rebuilt == room.snapshot()
+    # 合并后的增量与逐个应用的结果相同，断线补发用的也是它
+    assert apply_patch(initial, merge_patches(patches)) == room.snapshot()
+    assert apply_patch(initial, room.patch_since(0)) == room.snapshot()
+
+def test_snapshot_uses_published_version():
+    room = start_room(0)
+    play(room.state, random.Random(0), moves=3)
+    room.publish(room.current_player(), room.current_round())
+    published = room.snapshot()
+    # AI回合中已执行但还没发布的行动不出现在完整状态中
+    play(room.state, random.Random(1), moves=3)
+    assert room.snapshot() == published
+
+_FRAME_HEADER = struct.Struct("<BIIHBBBB")
+
+def decode_snapshot(frame):
+    """解析完整状态帧，返回 (版本, 棋盘, 各玩家资源)"""
+    _, version, _, _, _, _, _, _ = _FRAME_HEADER.unpack_from(frame, 0)
+    offset = _FRAME_HEADER.size
+    n = frame[offset]
+    offset += 1
+    for _ in range(n):
+        offset += 1 + frame[offset]
+    grid_size = frame[offset]
+    offset += 1
+    board = bytearray(frame[offset:offset + grid_size * grid_size])
+    offset += grid_size * grid_size
+    resources = [list(struct.unpack_from("<HH", frame, offset + 4 * i)) for i in range(n)]
+    return version, board, resources
+
+def apply_patch_frame(decoded, frame):
+    version, board, resources = decoded
+    board = bytearray(board)
+    resources = [r[:] for r in resources]
+    _, new_version, base, _, _, _, _, _ = _FRAME_HEADER.unpack_from(frame, 0)
+    assert base == version
+    offset = _FRAME_HEADER.size
+    count, = struct.unpack_from("<H", frame, offset)
+    offset += 2
+    for _ in range(count):
+        idx, code = struct.unpack_from("<HB", frame, offset)
+        assert code >= PLAYER_BASE
+        board[idx] = code
+        offset += 3
+    changed = frame[offset]
+    offset += 1
+    for _ in range(changed):
+        seat, wood, gold = struct.unpack_from("<Bhh", frame, offset)
+        resources[seat][0] += wood
+        resources[seat][1] += gold
+        offset += 5
+    return new_version, board, resources
+
+def test_binary_frames_rebuild_snapshot():
+    room = start_room(4)
+    state = room.state
+    def snapshot_frame():
+        return encode_snapshot(state, room.sent_board, room.sent_resources, room.header, room.version,
+                               room.sent_events)
+    decoded = decode_snapshot(snapshot_frame())
+    rng = random.Random(4)
+    for _ in range(15):
+        play(state, rng, moves=1)
+        room.publish(room.current_player(), room.current_round())
+    initial = decoded
+    for patch in room.pending:
+        decoded = apply_patch_frame(decoded, encode_patch(state.players, state.grid_size, patch))
+    coalesced = apply_patch_frame(initial, encode_patch(state.players, state.grid_size, merge_patches(room.pending)))
+    expected = decode_snapshot(snapshot_frame())
+    assert decoded == expected
+    assert coalesced == expected
+    assert bytes(expected[1]) == bytes(state.board)
+
+def test_value_store_round_trip(tmp_path):
+    path = str(tmp_path / "values.tvs")
+    state = play(new_game(6), random.Random(6))
+    store = ValueStore(path, capacity=1 << 12)
+    assert store.get(store_key(state)) is None
+    assert store.learn(state.log) == len(state.moves)
+    max_possible_score = state.grid_size * state.grid_size + 20
+    values = [state.calculate_score(p) / max_possible_score for p in state.players]
+    count, stored = store.get(store_key(state))
+    assert count == 1
+    assert list(stored[:len(values)]) == pytest.approx(values)
+    # 同一局再学一次：样本数增加，平均值不变；另一个实例从同一个文件读到相同的记录
+    store.learn(state.log)
+    store.close()
+    reopened = ValueStore(path)
+    count, stored = reopened.get(store_key(state))
+    assert count == 2
+    assert list(stored[:len(values)]) == pytest.approx(values)
+    positions = []
+    replay(state.log, visit=lambda s: positions.append(store_key(s)))
+    assert all(reopened.get(key) is not None for key in positions)
+    reopened.close()
+
+def test_learn_game_writes_in_background(tmp_path, monkeypatch):
+    import server
+    state = play(new_game(10), random.Random(10))
+    # 价值库所在的目录还不存在，第一次写入时创建
+    store = ValueStore(str(tmp_path / "data" / "values.tvs"), capacity=1 << 12)
+    monkeypatch.setattr(server, "value_store", store)
+    server.learn_game(state)
+    server.learn_queue.join()
+    count, _ = store.get(store_key(state))
+    assert count == 1
+    store.close()
+
+def test_value_store_skips_unfinished_game(tmp_path):
+    state = play(new_game(7), random.Random(7), moves=10)
+    store = ValueStore(str(tmp_path / "values.tvs"), capacity=1 << 10)
+    assert store.learn(state.log) == 0
+
+def test_opening_book_round_trip(tmp_path):
+    path = str(tmp_path / "opening.tob")
+    layout_seed = random.Random(8).getrandbits(64) & ((1 << SYMMETRY_SHIFT) - 1)
+    entries = {}
+    expected = []
+    state = GameState(9, PLAYERS, seed=layout_seed)
+    state.check_and_trigger_events()
+    rng = random.Random(8)
+    for _ in range(4):
+        player = state.players[state.turn % 3]
+        move = rng.choice([m for m in state.executable_moves(player) if m[0] == "occupy"])
+        key, t = canonical_key(state)
+        entries[key] = encode_move(transform_move(move, 9, t), 9)
+        expected.append((state.copy(), move))
+        state.apply_move(player, move)
+    OpeningBook.save(path, entries, [(9, 3, layout_seed)], 4)
+    book = OpeningBook(path)
+    assert len(book) == len(entries)
+    for position, move in expected:
+        assert book.lookup(position) == move
+    assert book.lookup(state) is None  # 超出覆盖的回合数
+    assert book.random_seed(9, 3) & ((1 << SYMMETRY_SHIFT) - 1) == layout_seed
+    assert book.random_seed(9, 2) is None
+    # 同一布局的对称变换：查到的行动按同一变换映射
+    for t in range(8):
+        mirrored = GameState(9, PLAYERS, seed=layout_seed | (t << SYMMETRY_SHIFT))
+        mirrored.check_and_trigger_events()
+        assert book.lookup(mirrored) == transform_move(expected[0][1], 9, t)
+
+def test_opening_book_missing_file(tmp_path):
+    book = OpeningBook(str(tmp_path / "missing.tob"))
+    assert len(book) == 0
+    assert book.lookup(new_game(9)) is None
+    assert book.random_seed(9, 3) is None